@@ -0,0 +1,403 @@
+"""Load-testing benchmark for the restaurant servers.
+
+Seeds a fresh database at the given scale, starts one of the servers
+locally on it, drives a mixed read/write workload against it with
+concurrent keep-alive clients, and reports throughput and latency
+percentiles (overall and per endpoint) as JSON:
+
+    python benchmark.py flask --restaurants 1000 --items 50 --duration 30
+    python benchmark.py webserver --concurrency 16 --output results.json
+
+Failed requests (connection errors and 5xx responses) are counted per
+endpoint, and the run exits with an error when they exceed
+--max-error-rate.
+
+Targets are `flask` (flask/restaurants.py), `webserver`
+(webserver/webserver.py) and `aioserver` (webserver/aioserver.py).
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COURSES = ('Appetizer', 'Entree', 'Dessert', 'Beverage')
+
+
+# Workloads: (name, weight, write, request), where request is called
+# with a random generator and the seeded scale, and returns
+# (method, path, form).
+
+def restaurant_id(rng, scale):
+    return rng.randint(1, scale['restaurants'])
+
+
+def item_id(rng, scale):
+    return rng.randint(1, scale['restaurants'] * scale['items'])
+
+
+def item_path(id_, scale):
+    # Seeded items are numbered restaurant after restaurant.
+    restaurant_id = (id_ - 1) // scale['items'] + 1
+    return f'/api/restaurants/{restaurant_id}/items/{id_}/'
+
+
+def item_form(rng):
+    return {
+        'name': f'Benchmark item {rng.randint(1, 10 ** 6)}',
+        'price': f'{rng.randint(99, 2999) / 100:.2f}',
+        'description': 'Added by the benchmark',
+        'course': rng.choice(COURSES),
+    }
+
+
+FLASK_WORKLOAD = [
+    ('index', 10, False,
+     lambda rng, scale: ('GET', '/', None)),
+    ('restaurant_detail', 30, False,
+     lambda rng, scale: ('GET', f'/restaurants/{restaurant_id(rng, scale)}/',
+                         None)),
+    ('api_restaurants', 10, False,
+     lambda rng, scale: ('GET', '/api/restaurants/', None)),
+    ('api_restaurant_detail', 30, False,
+     lambda rng, scale: ('GET',
+                         f'/api/restaurants/{restaurant_id(rng, scale)}/',
+                         None)),
+    ('api_item', 20, False,
+     lambda rng, scale: ('GET', item_path(item_id(rng, scale), scale), None)),
+    ('api_items_batch', 5, False,
+     lambda rng, scale: ('GET', '/api/items/?ids=' + ','.join(
+         str(item_id(rng, scale)) for _ in range(50)), None)),
+    ('add_item', 5, True,
+     lambda rng, scale: ('POST', f'/restaurants/{restaurant_id(rng, scale)}'
+                                 '/items/add/', item_form(rng))),
+    ('edit_restaurant', 5, True,
+     lambda rng, scale: ('POST',
+                         f'/restaurants/{restaurant_id(rng, scale)}/edit',
+                         {'name': f'Restaurant {rng.randint(1, 10 ** 6)}'})),
+]
+
+WEBSERVER_WORKLOAD = [
+    ('list_restaurants', 30, False,
+     lambda rng, scale: ('GET', '/restaurants', None)),
+    ('edit_restaurant_form', 40, False,
+     lambda rng, scale: ('GET',
+                         f'/restaurants/{restaurant_id(rng, scale)}/edit',
+                         None)),
+    ('hello_form', 30, False,
+     lambda rng, scale: ('GET', '/hello', None)),
+    ('add_restaurant', 5, True,
+     lambda rng, scale: ('POST', '/restaurants/new',
+                         {'name': f'Restaurant {rng.randint(1, 10 ** 6)}'})),
+    ('edit_restaurant', 5, True,
+     lambda rng, scale: ('POST',
+                         f'/restaurants/{restaurant_id(rng, scale)}/edit',
+                         {'name': f'Restaurant {rng.randint(1, 10 ** 6)}'})),
+]
+
+TARGETS = {
+    'flask': {
+        'directory': os.path.join(HERE, 'flask'),
+        'command': lambda port, threads: [
+            sys.executable, '-c',
+            'import restaurants; '
+            'restaurants.app.secret_key = "benchmark"; '
+            f'restaurants.app.run(port={port}, threaded=True)'],
+        'workload': FLASK_WORKLOAD,
+        # Run once the database is seeded.
+        'prepare': [sys.executable,
+                    os.path.join(HERE, 'flask', 'migrate.py'),
+                    '--rebuild-summaries'],
+    },
+    'webserver': {
+        'directory': os.path.join(HERE, 'webserver'),
+        'command': lambda port, threads: [
+            sys.executable, os.path.join(HERE, 'webserver', 'webserver.py'),
+            '--port', str(port), '--threads', str(threads)],
+        'workload': WEBSERVER_WORKLOAD,
+    },
+    'aioserver': {
+        'directory': os.path.join(HERE, 'webserver'),
+        'command': lambda port, threads: [
+            sys.executable, os.path.join(HERE, 'webserver', 'aioserver.py'),
+            '--port', str(port), '--threads', str(threads)],
+        'workload': WEBSERVER_WORKLOAD,
+    },
+}
+
+
+# Database
+
+def get_columns(connection, table):
+    rows = connection.execute(f'PRAGMA table_info({table})')
+    return [row[1] for row in rows]
+
+
+def insert(connection, table, rows):
+    """Insert rows, keeping only the columns the table actually has."""
+    columns = [column for column in get_columns(connection, table)
+               if column in rows[0]]
+    placeholders = ', '.join('?' * len(columns))
+    connection.executemany(
+        f'INSERT INTO {table} ({", ".join(columns)}) '
+        f'VALUES ({placeholders})',
+        ([row[column] for column in columns] for row in rows))
+
+
+def seed(workdir, directory, restaurants, items, rng, batch_size=10000):
+    """Create the target's database in workdir and fill it."""
+    env = dict(os.environ, PYTHONPATH=directory)
+    # The models create their tables when imported.
+    subprocess.run([sys.executable, '-c', 'import database_setup'],
+                   cwd=workdir, env=env, check=True)
+    now = datetime.utcnow().isoformat(' ')
+    connection = sqlite3.connect(os.path.join(workdir, 'restaurantmenu.db'))
+    with connection:
+        insert(connection, 'restaurant', [
+            {'id': id_, 'name': f'Restaurant #{id_}', 'version': 1,
+             'updated_at': now}
+            for id_ in range(1, restaurants + 1)])
+    rows = []
+    for id_ in range(1, restaurants * items + 1):
+        cents = rng.randint(99, 2999)
+        rows.append({
+            'id': id_,
+            'name': f'Item #{id_}',
+            'course': rng.choice(COURSES),
+            'description': 'Seeded by the benchmark',
+            'price': f'{cents / 100:.2f}',
+            'price_cents': cents,
+            'restaurant_id': (id_ - 1) // items + 1,
+            'version': 1,
+            'updated_at': now,
+        })
+        if len(rows) == batch_size:
+            with connection:
+                insert(connection, 'menu_item', rows)
+            rows = []
+    if rows:
+        with connection:
+            insert(connection, 'menu_item', rows)
+    connection.close()
+
+
+# Server
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_listening(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The server exited during startup.')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'The server did not listen on port {port}.')
+
+
+# Load
+
+class Client(threading.Thread):
+    """Send requests over a keep-alive connection until `deadline`."""
+
+    def __init__(self, port, workload, scale, deadline, write_ratio, seed):
+        super().__init__()
+        self.port = port
+        self.reads = [entry for entry in workload if not entry[2]]
+        self.writes = [entry for entry in workload if entry[2]]
+        self.scale = scale
+        self.deadline = deadline
+        self.write_ratio = write_ratio
+        self.rng = random.Random(seed)
+        # (name, status, seconds), status being 'error' when the request
+        # failed without a response.
+        self.samples = []
+
+    def pick(self):
+        entries = self.reads
+        if self.writes and self.rng.random() < self.write_ratio:
+            entries = self.writes
+        return self.rng.choices(entries,
+                                weights=[entry[1] for entry in entries])[0]
+
+    def run(self):
+        connection = HTTPConnection('127.0.0.1', self.port, timeout=30)
+        while time.monotonic() < self.deadline:
+            name, _, _, request = self.pick()
+            method, path, form = request(self.rng, self.scale)
+            body, headers = None, {'Accept-Encoding': 'gzip'}
+            if form is not None:
+                body = urlencode(form)
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, ValueError):
+                self.samples.append((name, 'error',
+                                     time.perf_counter() - start))
+                connection.close()
+                continue
+            self.samples.append((name, response.status,
+                                 time.perf_counter() - start))
+            if response.will_close:
+                connection.close()
+        connection.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def failed(status):
+    """Whether a sample's status is a connection error or a server error."""
+    return status == 'error' or status >= 500
+
+
+def summarize(samples, duration):
+    latencies = sorted(seconds for _, _, seconds in samples)
+    statuses = {}
+    for _, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(1 for _, status, _ in samples if failed(status))
+    return {
+        'requests': len(samples),
+        'throughput': len(samples) / duration,
+        'statuses': statuses,
+        'errors': errors,
+        'error_rate': errors / len(samples) if samples else 0,
+        'latency_ms': {
+            name: None if value is None else value * 1000
+            for name, value in (
+                ('p50', percentile(latencies, .50)),
+                ('p95', percentile(latencies, .95)),
+                ('p99', percentile(latencies, .99)),
+                ('max', latencies[-1] if latencies else None),
+            )
+        },
+    }
+
+
+def run(args):
+    target = TARGETS[args.target]
+    rng = random.Random(args.seed)
+    scale = {'restaurants': args.restaurants, 'items': args.items}
+    workdir = tempfile.mkdtemp(prefix='restaurants-benchmark-')
+    process = None
+    try:
+        print(f'Seeding {args.restaurants} restaurants '
+              f'x {args.items} items...', file=sys.stderr)
+        seed(workdir, target['directory'], args.restaurants, args.items, rng)
+        env = dict(os.environ, PYTHONPATH=target['directory'])
+        if 'prepare' in target:
+            subprocess.run(target['prepare'], cwd=workdir, env=env,
+                           stdout=subprocess.DEVNULL, check=True)
+
+        port = free_port()
+        process = subprocess.Popen(target['command'](port, args.threads),
+                                   cwd=workdir, env=env,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        wait_until_listening(port, process)
+
+        print(f'Running for {args.duration}s with {args.concurrency} '
+              'clients...', file=sys.stderr)
+        start = time.monotonic()
+        clients = [Client(port, target['workload'], scale,
+                          start + args.duration, args.write_ratio,
+                          rng.random())
+                   for _ in range(args.concurrency)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        duration = time.monotonic() - start
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    samples = [sample for client in clients for sample in client.samples]
+    names = [entry[0] for entry in target['workload']]
+    return {
+        'target': args.target,
+        'scale': scale,
+        'concurrency': args.concurrency,
+        'threads': args.threads,
+        'write_ratio': args.write_ratio,
+        'duration': duration,
+        'overall': summarize(samples, duration),
+        'endpoints': {
+            name: summarize([sample for sample in samples
+                             if sample[0] == name], duration)
+            for name in names
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.splitlines()[2:]))
+    parser.add_argument('target', choices=sorted(TARGETS))
+    parser.add_argument('--restaurants', type=int, default=100)
+    parser.add_argument('--items', type=int, default=20,
+                        help='Menu items per restaurant.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds of load (default: 10).')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Concurrent clients (default: 8).')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Server threads, where supported (default: 8).')
+    parser.add_argument('--write-ratio', type=float, default=0.1,
+                        help='Fraction of write requests (default: 0.1).')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, for reproducible runs.')
+    parser.add_argument('--max-error-rate', type=float, default=0.01,
+                        help='Fraction of failed requests (connection '
+                             'errors and 5xx responses) above which the '
+                             'run fails (default: 0.01).')
+    parser.add_argument('--output', help='Write the JSON report to a file.')
+    args = parser.parse_args()
+
+    results = run(args)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+    error_rate = results['overall']['error_rate']
+    if error_rate > args.max_error_rate:
+        sys.exit(f'Error rate {error_rate:.2%} above the maximum of '
+                 f'{args.max_error_rate:.2%}, see the per-endpoint errors.')
+
+
+if __name__ == '__main__':
+    main()
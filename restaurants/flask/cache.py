@@ -0,0 +1,295 @@
+"""Cache backends.
+
+All backends implement the Cache interface and take string keys.
+LRUCache lives in the memory of a single process; SQLiteCache is stored
+in a file, so that all worker processes of a server can share it.
+"""
+
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class Cache:
+    """Interface of cache backends."""
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default."""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """Store a value for key."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove key from the cache, if present."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """Return a dict of the values found for the given keys.
+
+        Keys that are not in the cache are absent from the dict.
+        """
+        missing = object()
+        values = ((key, self.get(key, missing)) for key in keys)
+        return {key: value for key, value in values if value is not missing}
+
+    def set_many(self, mapping):
+        """Store all the values of a {key: value} mapping."""
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    @property
+    def stats(self):
+        """Dictionary of counters, useful to tune the cache."""
+        raise NotImplementedError
+
+
+class LRUCache(Cache):
+    """Thread-safe, bounded least-recently-used cache with expiry.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries. When full, the least recently used
+        entry is evicted to make room for a new one.
+    ttl : float
+        Number of seconds after which an entry expires.
+    clock : callable
+        Return the current time in seconds. Default is time.monotonic.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default."""
+        with self._lock:
+            return self._get(key, default)
+
+    def _get(self, key, default):
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires <= self.clock():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store a value for key."""
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_many(self, keys):
+        """Return a dict of the values found for the given keys."""
+        missing = object()
+        with self._lock:
+            values = [(key, self._get(key, missing)) for key in keys]
+        return {key: value for key, value in values if value is not missing}
+
+    def set_many(self, mapping):
+        """Store all the values of a {key: value} mapping."""
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, value)
+
+    def delete(self, key):
+        """Remove key from the cache, if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        """Dictionary of counters, useful to tune maxsize and ttl."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class SQLiteCache(Cache):
+    """Bounded cache with expiry, stored in an SQLite file.
+
+    Every process opening the same file shares the same entries, which
+    makes it a local stand-in for memcached or Redis. Values are pickled.
+    When full, the entries closest to expiry (i.e. the oldest ones) are
+    evicted first. Counters in `stats` are those of the current process.
+
+    Parameters
+    ----------
+    path : str
+        Path to the cache file, created if needed.
+    maxsize : int
+    ttl : float
+    timeout : float
+        Seconds to wait for a lock held by another process.
+    clock : callable
+        Return the current time in seconds. Must agree across processes.
+        Default is time.time.
+    """
+
+    # SQLite's default limit on the number of bound parameters is 999.
+    batch_size = 500
+
+    def __init__(self, path, maxsize=1024, ttl=300, timeout=5,
+                 clock=time.time):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timeout = timeout
+        self.clock = clock
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'key TEXT PRIMARY KEY, '
+                               'value BLOB NOT NULL, '
+                               'expires REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_expires '
+                               'ON cache (expires)')
+
+    def _connection(self):
+        """Return the connection of the current thread.
+
+        Used as a context manager, it wraps statements in a transaction.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            # Readers do not block writers (and vice versa) in WAL mode.
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default."""
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """Return a dict of the values found for the given keys.
+
+        Keys are looked up with one query per batch of keys.
+        """
+        keys = list(keys)
+        now = self.clock()
+        values = {}
+        connection = self._connection()
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            placeholders = ', '.join('?' * len(batch))
+            rows = connection.execute(
+                'SELECT key, value FROM cache '
+                f'WHERE key IN ({placeholders}) AND expires > ?',
+                batch + [now])
+            values.update((key, pickle.loads(value)) for key, value in rows)
+        self.hits += len(values)
+        self.misses += len(keys) - len(values)
+        return values
+
+    def set(self, key, value):
+        """Store a value for key."""
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        """Store the values of a {key: value} mapping in one transaction."""
+        expires = self.clock() + self.ttl
+        rows = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+                for key, value in mapping.items()]
+        with self._connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO cache '
+                                   '(key, value, expires) VALUES (?, ?, ?)',
+                                   rows)
+            self._prune(connection)
+
+    def _prune(self, connection):
+        connection.execute('DELETE FROM cache WHERE expires <= ?',
+                           (self.clock(),))
+        cursor = connection.execute(
+            'DELETE FROM cache WHERE key IN ('
+            'SELECT key FROM cache ORDER BY expires DESC '
+            'LIMIT -1 OFFSET ?)', (self.maxsize,))
+        self.evictions += cursor.rowcount
+
+    def delete(self, key):
+        """Remove key from the cache, if present."""
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache')
+
+    @property
+    def stats(self):
+        """Dictionary of counters, useful to tune maxsize and ttl."""
+        size, = self._connection().execute(
+            'SELECT COUNT(*) FROM cache').fetchone()
+        return {
+            'size': size,
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+BACKENDS = {
+    'memory': LRUCache,
+    'sqlite': SQLiteCache,
+}
+
+
+def create_cache(backend='memory', **options):
+    """Create a cache and return it.
+
+    Parameters
+    ----------
+    backend : str
+        One of the keys of BACKENDS.
+    **options : passed to the backend's constructor.
+    """
+    return BACKENDS[backend](**options)
@@ -0,0 +1,613 @@
+"""Database engine and session management."""
+
+import re
+import json
+from datetime import datetime
+from operator import attrgetter
+from itertools import groupby
+
+from sqlalchemy import create_engine, event, literal_column, func, case, \
+    bindparam, select
+from sqlalchemy.orm import scoped_session, sessionmaker, joinedload, \
+    selectinload
+from sqlalchemy.pool import QueuePool
+
+from database_setup import Restaurant, MenuItem, RestaurantSummary, \
+    menu_search, format_cents, parse_price
+
+
+# Eager-loading strategies for a restaurant's menu items.
+# 'joined' fetches the restaurant and its items in a single query;
+# 'selectin' uses a second query, which avoids duplicating the restaurant
+# columns on every row of large menus.
+LOADERS = {
+    'joined': joinedload,
+    'selectin': selectinload,
+}
+
+# Upper bounds, in cents, of the price ranges counted by get_item_facets().
+PRICE_BUCKETS = (500, 1000, 1500, 2500)
+
+# Settings for concurrent access to an SQLite database: in WAL mode,
+# readers do not block writers and vice versa, and fsync only happens
+# at checkpoints (which is still safe against application crashes).
+SQLITE_PERFORMANCE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # milliseconds
+    'cache_size': -64000,  # kibibytes, i.e. 64MB
+    'mmap_size': 268435456,  # bytes, i.e. 256MB
+}
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """Run PRAGMA statements on every new connection of an SQLite engine.
+
+    Parameters
+    ----------
+    engine : Engine
+    pragmas : dict
+        Maps pragma names to values, e.g. {'journal_mode': 'WAL'}.
+    """
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def create_db_engine(uri, pool_size=5, max_overflow=10, pool_timeout=30,
+                     pool_recycle=3600, pool_pre_ping=True, pragmas=None,
+                     read_only=False):
+    """Create an engine backed by a connection pool and return it.
+
+    Parameters
+    ----------
+    uri : str
+        SQLAlchemy database URI.
+    pool_size : int
+        Number of connections kept open in the pool.
+    max_overflow : int
+        Number of extra connections allowed when the pool is exhausted.
+    pool_timeout : int
+        Seconds to wait for a connection before giving up.
+    pool_recycle : int
+        Connections older than this many seconds are replaced.
+        Use -1 to never recycle.
+    pool_pre_ping : bool
+        Whether to test connections for liveness when checked out.
+    pragmas : dict, optional
+        SQLite only. See set_sqlite_pragmas().
+    read_only : bool
+        SQLite only. Whether to reject writes on the engine's connections.
+    """
+    connect_args = {}
+    sqlite = uri.startswith('sqlite')
+    if sqlite:
+        # Pooled connections are handed out to whichever thread
+        # serves the request, not the one that opened them.
+        connect_args['check_same_thread'] = False
+    engine = create_engine(uri,
+                           poolclass=QueuePool,
+                           pool_size=pool_size,
+                           max_overflow=max_overflow,
+                           pool_timeout=pool_timeout,
+                           pool_recycle=pool_recycle,
+                           pool_pre_ping=pool_pre_ping,
+                           connect_args=connect_args)
+    if sqlite:
+        pragmas = dict(pragmas or {})
+        if read_only:
+            pragmas['query_only'] = 'ON'
+        if pragmas:
+            set_sqlite_pragmas(engine, pragmas)
+    return engine
+
+
+def create_db(engine):
+    """Create a scoped session registry bound to the engine and return it.
+
+    Each thread gets its own session. Call `remove()` on the registry
+    when a unit of work (e.g. a request) is over to release it.
+    """
+    return scoped_session(sessionmaker(bind=engine))
+
+
+def get_restaurant_version(db, restaurant_id):
+    """Return the (version, updated_at) of a restaurant.
+
+    Raise NoResultFound if there is no such restaurant.
+    """
+    return (db.query(Restaurant.version, Restaurant.updated_at)
+            .filter_by(id=restaurant_id)
+            .one())
+
+
+def get_restaurant_with_items(db, restaurant_id, loader='joined'):
+    """Return a restaurant with its menu items already loaded.
+
+    Raise NoResultFound if there is no such restaurant.
+
+    Parameters
+    ----------
+    db : Session
+    restaurant_id : int
+    loader : str
+        One of the keys of LOADERS.
+    """
+    return (db.query(Restaurant)
+            .options(LOADERS[loader](Restaurant.items))
+            .filter_by(id=restaurant_id)
+            .one())
+
+
+def paginate(query, id_column, limit, after=None, key=attrgetter('id')):
+    """Return a page of a query's rows ordered by id, and the next cursor.
+
+    Pages are selected by keyset (`id > after`) rather than by offset,
+    so that fetching a page costs the same however deep it is.
+    The cursor is None on the last page.
+
+    Parameters
+    ----------
+    query : Query
+    id_column : Column
+        The id to order rows by, e.g. Restaurant.id.
+    limit : int
+        Maximum number of rows on the page.
+    after : int, optional
+        Id of the last row of the previous page.
+    key : callable
+        Return the id of a row, which is its `id` attribute by default.
+    """
+    query = query.order_by(id_column)
+    if after is not None:
+        query = query.filter(id_column > after)
+    # Fetch one extra row to know whether there is a next page.
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, key(rows[-1])
+    return rows, None
+
+
+def paginate_restaurants(db, limit, after=None, columns=None):
+    """Return a page of restaurants ordered by id, and the next cursor.
+
+    See paginate().
+
+    Parameters
+    ----------
+    db : Session
+    limit : int
+        Maximum number of restaurants on the page.
+    after : int, optional
+        Id of the last restaurant of the previous page.
+    columns : list, optional
+        Restaurant columns to select instead of whole restaurants.
+        Must include Restaurant.id.
+    """
+    return paginate(db.query(*(columns or [Restaurant])), Restaurant.id,
+                    limit, after)
+
+
+def paginate_restaurant_summaries(db, limit, after=None):
+    """Return a page of (restaurant, summary) pairs, and the next cursor.
+
+    Summaries are read along with restaurants, in the same query.
+    See paginate_restaurants().
+    """
+    query = (db.query(Restaurant, RestaurantSummary)
+             .outerjoin(RestaurantSummary,
+                        RestaurantSummary.restaurant_id == Restaurant.id))
+    return paginate(query, Restaurant.id, limit, after,
+                    key=lambda row: row[0].id)
+
+
+def iter_menus(db, batch_size=1000):
+    """Yield (restaurant, items) pairs for every restaurant, ordered by id.
+
+    Rows are fetched from the database `batch_size` at a time, so the
+    whole set of restaurants and menus is never held in memory at once.
+    """
+    rows = (db.query(Restaurant, MenuItem)
+            .outerjoin(MenuItem, MenuItem.restaurant_id == Restaurant.id)
+            .order_by(Restaurant.id, MenuItem.id)
+            .yield_per(batch_size))
+    current, items = None, []
+    for restaurant, item in rows:
+        if restaurant is not current:
+            if current is not None:
+                yield current, items
+            current, items = restaurant, []
+        if item is not None:
+            items.append(item)
+    if current is not None:
+        yield current, items
+
+
+def make_match_query(text):
+    """Return the FTS5 query matching words starting with those of a text.
+
+    Return None if the text has no words. Every word must match,
+    e.g. 'cheese burg' -> '"cheese"* "burg"*'.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_items(db, match_query, limit, offset=0):
+    """Return a page of menu items matching a full-text query, best first.
+
+    Return a list of (item, restaurant) pairs, and whether there
+    are more results.
+
+    Parameters
+    ----------
+    db : Session
+    match_query : str
+        FTS5 query, see make_match_query().
+    limit : int
+    offset : int
+    """
+    # Rank and paginate in the full-text index first, so that only the
+    # items of the page are loaded.
+    ranked = (db.query(menu_search.c.rowid.label('id'),
+                       menu_search.c.rank.label('rank'))
+              .filter(literal_column('menu_search').op('MATCH')(match_query))
+              .order_by(menu_search.c.rank)
+              .limit(limit + 1)
+              .offset(offset)
+              .subquery())
+    results = (db.query(MenuItem, Restaurant)
+               .join(MenuItem.restaurant)
+               .join(ranked, ranked.c.id == MenuItem.id)
+               .order_by(ranked.c.rank)
+               .all())
+    return results[:limit], len(results) > limit
+
+
+def filter_items(query, restaurant_id=None, courses=None, min_price=None,
+                 max_price=None):
+    """Return a query of menu items restricted to those matching filters.
+
+    Parameters
+    ----------
+    query : Query
+        Query involving MenuItem.
+    restaurant_id : int, optional
+    courses : list of str, optional
+        Keep items of any of these courses.
+    min_price, max_price : int, optional
+        Bounds of the price range in cents, inclusive.
+    """
+    if restaurant_id is not None:
+        query = query.filter(MenuItem.restaurant_id == restaurant_id)
+    if courses:
+        query = query.filter(MenuItem.course.in_(courses))
+    if min_price is not None:
+        query = query.filter(MenuItem.price_cents >= min_price)
+    if max_price is not None:
+        query = query.filter(MenuItem.price_cents <= max_price)
+    return query
+
+
+def paginate_items(query, limit, after=None):
+    """Return a page of a query's menu items ordered by id, and the next
+    cursor. See paginate().
+    """
+    return paginate(query, MenuItem.id, limit, after)
+
+
+def get_item_facets(db, restaurant_id=None, courses=None, min_price=None,
+                    max_price=None):
+    """Return the number of menu items per course and per price range.
+
+    Counts are computed by the database. Each facet is counted with all
+    filters but its own, so that counts tell how many items selecting
+    another course (or price range) would give. See filter_items() for
+    the parameters.
+
+    Return a dict with:
+    - 'courses': list of {'course', 'count'} dicts, most items first;
+    - 'prices': list of {'min', 'max', 'count'} dicts for the ranges
+      delimited by PRICE_BUCKETS, where 'max' is excluded and None for
+      the last range. Items without a price are not counted.
+    """
+    courses_query = filter_items(
+        db.query(MenuItem.course, func.count(MenuItem.id)),
+        restaurant_id, min_price=min_price, max_price=max_price)
+    course_counts = (courses_query
+                     .group_by(MenuItem.course)
+                     .order_by(func.count(MenuItem.id).desc(), MenuItem.course)
+                     .all())
+
+    bucket = case([(MenuItem.price_cents < bound, index)
+                   for index, bound in enumerate(PRICE_BUCKETS)],
+                  else_=len(PRICE_BUCKETS))
+    prices_query = filter_items(
+        db.query(bucket.label('bucket'), func.count(MenuItem.id)),
+        restaurant_id, courses)
+    bucket_counts = dict(prices_query
+                         .filter(MenuItem.price_cents.isnot(None))
+                         .group_by('bucket')
+                         .all())
+
+    bounds = (0,) + PRICE_BUCKETS + (None,)
+    return {
+        'courses': [{'course': course, 'count': count}
+                    for course, count in course_counts],
+        'prices': [{'min': format_cents(low),
+                    'max': None if high is None else format_cents(high),
+                    'count': bucket_counts.get(index, 0)}
+                   for index, (low, high) in enumerate(zip(bounds,
+                                                           bounds[1:]))],
+    }
+
+
+def get_items(db, ids):
+    """Return the menu items with the given ids, in a single query.
+
+    Ids of missing items are ignored.
+    """
+    if not ids:
+        return []
+    return db.query(MenuItem).filter(MenuItem.id.in_(set(ids))).all()
+
+
+def touch_restaurant(db, restaurant_id):
+    """Mark a restaurant as modified, see Restaurant.touch().
+
+    Being a write, this also starts the transaction of the session and,
+    on SQLite, locks the database for other writers until it is over.
+    Return whether the restaurant exists.
+    """
+    table = Restaurant.__table__
+    result = db.execute(table.update()
+                        .where(table.c.id == restaurant_id)
+                        .values(version=table.c.version + 1,
+                                updated_at=datetime.utcnow()))
+    return result.rowcount > 0
+
+
+def parse_item_change(data):
+    """Return the column values of an item to upsert, or raise ValueError.
+
+    Only the fields given are returned, along with the `id`: updates
+    leave the other columns of the item as they are, while they are
+    NULL for new items.
+
+    Parameters
+    ----------
+    data : dict
+        The `id` of the item to update, if any, and its `name`
+        (required for new items), `course`, `description` and `price`
+        (e.g. '7.50'). A null `course`, `description` or `price` clears
+        it.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Expected an object')
+    id_ = data.get('id')
+    if id_ is not None and (not isinstance(id_, int) or isinstance(id_, bool)):
+        raise ValueError('Invalid id')
+    values = {'id': id_}
+    if id_ is None or 'name' in data:
+        name = data.get('name')
+        if not isinstance(name, str) or not name:
+            raise ValueError('Missing name')
+        values['name'] = name
+    for field in ('course', 'description'):
+        if field in data:
+            value = data[field]
+            if value is not None and not isinstance(value, str):
+                raise ValueError(f'Invalid {field}')
+            values[field] = value
+    if 'price' in data:
+        price = data['price']
+        values['price_cents'] = parse_price(price)
+        if price not in (None, '') and values['price_cents'] is None:
+            raise ValueError('Invalid price')
+    return values
+
+
+def bulk_write_items(db, restaurant_id, upserts, deletes):
+    """Create, update and delete many items of a restaurant.
+
+    Statements are run with executemany in the session's transaction,
+    which must already hold the write lock (see touch_restaurant()),
+    so that ids cannot change meanwhile. Nothing is written if any
+    change is invalid: the valid ones are then 'skipped'.
+
+    Return the list of per-change results, and whether they were all
+    valid. Results are dicts with the `op` ('upsert' or 'delete'),
+    `index` of the change, item `id`, and `status`: 'created',
+    'updated', 'deleted', 'missing' (deleting an item which does not
+    exist), 'skipped' or 'error', with an `error` message.
+
+    Parameters
+    ----------
+    db : Session
+    restaurant_id : int
+    upserts : list of dict
+        Items to create, or to update if they have an `id`.
+        See parse_item_change().
+    deletes : list of int
+        Ids of items to delete.
+    """
+    table = MenuItem.__table__
+    results, changes = [], []
+    for index, data in enumerate(upserts):
+        result = {'op': 'upsert', 'index': index}
+        try:
+            values = parse_item_change(data)
+        except ValueError as e:
+            values = None
+            id_ = data.get('id') if isinstance(data, dict) else None
+            if not isinstance(id_, int) or isinstance(id_, bool):
+                id_ = None
+            result.update(id=id_, status='error', error=str(e))
+        else:
+            result['id'] = values['id']
+        results.append(result)
+        changes.append(values)
+    for index, id_ in enumerate(deletes):
+        result = {'op': 'delete', 'index': index, 'id': id_}
+        if not isinstance(id_, int) or isinstance(id_, bool):
+            result.update(status='error', error='Invalid id')
+        results.append(result)
+
+    ids = [result['id'] for result in results
+           if isinstance(result['id'], int) and 'error' not in result]
+    owners = dict(db.query(MenuItem.id, MenuItem.restaurant_id)
+                  .filter(MenuItem.id.in_(set(ids)))) if ids else {}
+    seen = set()
+    for result in results:
+        if 'error' in result:
+            continue
+        id_ = result['id']
+        if id_ is None:
+            result['status'] = 'created'
+            continue
+        if id_ in seen:
+            result.update(status='error', error='Duplicate id')
+        elif id_ not in owners:
+            if result['op'] == 'upsert':
+                result.update(status='error', error='No such item')
+            else:
+                result['status'] = 'missing'
+        elif owners[id_] != restaurant_id:
+            result.update(status='error',
+                          error='Item of another restaurant')
+        else:
+            result['status'] = ('updated' if result['op'] == 'upsert'
+                                else 'deleted')
+        seen.add(id_)
+    if any(result['status'] == 'error' for result in results):
+        for result in results:
+            if result['status'] != 'error':
+                result['status'] = 'skipped'
+        return results, False
+
+    now = datetime.utcnow()
+    # The write lock is held, so no other transaction can take these.
+    next_id = (db.query(func.max(MenuItem.id)).scalar() or 0) + 1
+    inserts = []
+    # Updates of the same columns are run together, keyed by columns.
+    updates = {}
+    for result, values in zip(results, changes):
+        if result['status'] == 'created':
+            result['id'] = values['id'] = next_id
+            next_id += 1
+            inserts.append(dict({'course': None, 'description': None,
+                                 'price_cents': None}, **values,
+                                restaurant_id=restaurant_id, version=1,
+                                updated_at=now))
+        elif result['status'] == 'updated':
+            columns = tuple(key for key in values if key != 'id')
+            updates.setdefault(columns, []).append(
+                {f'b_{key}': value for key, value in values.items()})
+    deleted = [result['id'] for result in results
+               if result['status'] == 'deleted']
+
+    if inserts:
+        db.execute(table.insert(), inserts)
+    for columns, rows in updates.items():
+        db.execute(table.update()
+                   .where(table.c.id == bindparam('b_id'))
+                   .values({column: bindparam(f'b_{column}')
+                            for column in columns},
+                           version=table.c.version + 1,
+                           updated_at=now),
+                   rows)
+    if deleted:
+        db.execute(table.delete().where(table.c.id.in_(deleted)))
+    return results, True
+
+
+def make_summary(restaurant_id, groups):
+    """Return the restaurant_summary row of a restaurant.
+
+    Parameters
+    ----------
+    restaurant_id : int
+    groups : iterable
+        (course, item count, min price, max price) aggregates of the
+        restaurant's items, per course. Groups of no items are ignored.
+    """
+    groups = [group for group in groups if group[1]]
+    min_prices = [group[2] for group in groups if group[2] is not None]
+    max_prices = [group[3] for group in groups if group[3] is not None]
+    courses = sorted(((course, count) for course, count, _, _ in groups),
+                     key=lambda pair: (-pair[1], pair[0] or ''))
+    return {
+        'restaurant_id': restaurant_id,
+        'item_count': sum(count for _, count in courses),
+        'min_price_cents': min(min_prices, default=None),
+        'max_price_cents': max(max_prices, default=None),
+        'courses': json.dumps(courses),
+    }
+
+
+def aggregate_items():
+    """Return the columns of the per-course aggregates of make_summary()."""
+    item = MenuItem.__table__
+    return [item.c.course, func.count(item.c.id),
+            func.min(item.c.price_cents), func.max(item.c.price_cents)]
+
+
+def refresh_restaurant_summary(db, restaurant_id):
+    """Compute the summary of a restaurant again, after its menu changed.
+
+    Pending changes of the session are flushed first, and the summary
+    is written in the session's transaction. A single query, on the
+    (restaurant_id, course) index, reads the restaurant's items.
+    """
+    db.flush()
+    item = MenuItem.__table__
+    groups = db.execute(select(aggregate_items())
+                        .where(item.c.restaurant_id == restaurant_id)
+                        .group_by(item.c.course)).fetchall()
+    row = make_summary(restaurant_id, groups)
+    summary = RestaurantSummary.__table__
+    result = db.execute(summary.update()
+                        .where(summary.c.restaurant_id == restaurant_id)
+                        .values(row))
+    if result.rowcount == 0:
+        db.execute(summary.insert(), row)
+
+
+def rebuild_restaurant_summaries(connection, batch_size=10000):
+    """Compute the summaries of all restaurants again, return how many.
+
+    Parameters
+    ----------
+    connection : Connection or Session
+    batch_size : int
+        Number of summaries inserted at once.
+    """
+    restaurant = Restaurant.__table__
+    item = MenuItem.__table__
+    summary = RestaurantSummary.__table__
+    connection.execute(summary.delete())
+    groups = connection.execute(
+        select([restaurant.c.id] + aggregate_items())
+        .select_from(restaurant.outerjoin(
+            item, item.c.restaurant_id == restaurant.c.id))
+        .group_by(restaurant.c.id, item.c.course)
+        .order_by(restaurant.c.id))
+    rows, count = [], 0
+    for restaurant_id, restaurant_groups in groupby(groups,
+                                                    lambda group: group[0]):
+        rows.append(make_summary(restaurant_id,
+                                 (group[1:] for group in restaurant_groups)))
+        if len(rows) == batch_size:
+            connection.execute(summary.insert(), rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        connection.execute(summary.insert(), rows)
+        count += len(rows)
+    return count
@@ -1,18 +1,62 @@
 """Database setup."""
 
+import re
+import json
+from datetime import datetime
+from decimal import Decimal
+
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
-from sqlalchemy import Column, String, Integer, ForeignKey
+from sqlalchemy import create_engine, event, DDL
+from sqlalchemy import Column, String, Integer, DateTime, Text, \
+    ForeignKey, Index
+from sqlalchemy.sql import table, column
 
 
 Base = declarative_base()
 
 
+def parse_price(value):
+    """Return a price as an integer number of cents, or None.
+
+    Anything around the amount (e.g. a currency symbol) is ignored.
+
+    parse_price('7.50') -> 750
+    parse_price('$.99') -> 99
+    parse_price(25) -> 2500
+    """
+    match = re.search(r'\d*\.?\d+', str(value or ''))
+    if match is None:
+        return None
+    return int((Decimal(match.group()) * 100).to_integral_value())
+
+
+def format_cents(cents):
+    """Return an integer number of cents as a decimal string.
+
+    format_cents(750) -> '7.50'
+    """
+    return '{}.{:02d}'.format(*divmod(cents, 100))
+
+
 class Restaurant(Base):
     __tablename__ = 'restaurant'
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
+    # Bumped whenever the restaurant or its menu changes.
+    version = Column(Integer, nullable=False, default=1)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    items = relationship('MenuItem', back_populates='restaurant',
+                         order_by='MenuItem.id',
+                         cascade='all, delete-orphan')
+    summary = relationship('RestaurantSummary', uselist=False,
+                           cascade='all, delete-orphan')
+
+    def touch(self):
+        """Mark the restaurant, or its menu, as modified."""
+        # Incremented in SQL so that concurrent edits are not lost.
+        self.version = Restaurant.version + 1
+        self.updated_at = datetime.utcnow()
 
     @property
     def serialized(self):
@@ -24,13 +68,37 @@ class Restaurant(Base):
 
 class MenuItem(Base):
     __tablename__ = 'menu_item'
+    __table_args__ = (
+        Index('ix_menu_item_restaurant_id_course', 'restaurant_id', 'course'),
+        # For price ranges across restaurants.
+        Index('ix_menu_item_price_cents', 'price_cents'),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
     course = Column(String(250))
     description = Column(String(250))
-    price = Column(String(8))
-    restaurant_id = Column(Integer, ForeignKey('restaurant.id'))
-    restaurant = relationship(Restaurant)
+    price_cents = Column(Integer)
+    # Also serves menus ordered by id, which the index above cannot do.
+    restaurant_id = Column(Integer, ForeignKey('restaurant.id'), index=True)
+    restaurant = relationship(Restaurant, back_populates='items')
+    version = Column(Integer, nullable=False, default=1)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def touch(self):
+        """Mark the item as modified."""
+        self.version = MenuItem.version + 1
+        self.updated_at = datetime.utcnow()
+
+    @property
+    def price(self):
+        """Price as a decimal string (e.g. '7.50'), or None."""
+        if self.price_cents is None:
+            return None
+        return format_cents(self.price_cents)
+
+    @price.setter
+    def price(self, value):
+        self.price_cents = parse_price(value)
 
     @property
     def serialized(self):
@@ -43,5 +111,92 @@ class MenuItem(Base):
         }
 
 
+class RestaurantSummary(Base):
+    """Figures of a restaurant's menu, precomputed for listings.
+
+    Kept up to date by database.refresh_restaurant_summary(), and
+    rebuilt from scratch by `python migrate.py --rebuild-summaries`.
+    """
+    __tablename__ = 'restaurant_summary'
+    restaurant_id = Column(Integer, ForeignKey('restaurant.id'),
+                           primary_key=True)
+    item_count = Column(Integer, nullable=False, default=0)
+    min_price_cents = Column(Integer)
+    max_price_cents = Column(Integer)
+    # JSON list of [course, number of items] pairs, most items first.
+    courses = Column(Text, nullable=False, default='[]')
+
+    @property
+    def course_counts(self):
+        return json.loads(self.courses)
+
+    @property
+    def min_price(self):
+        if self.min_price_cents is None:
+            return None
+        return format_cents(self.min_price_cents)
+
+    @property
+    def max_price(self):
+        if self.max_price_cents is None:
+            return None
+        return format_cents(self.max_price_cents)
+
+
+class BulkRequest(Base):
+    """A bulk write already applied, by its client-supplied key."""
+    __tablename__ = 'bulk_request'
+    key = Column(String(250), primary_key=True)
+    restaurant_id = Column(Integer, nullable=False)
+    # The JSON response, sent again if the request is repeated.
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        index=True)
+
+
+# Full-text index of menu items, by name, description and restaurant
+# name (SQLite FTS5). Its rowids are menu item ids. It is kept in sync
+# by triggers, so that writes made outside of the ORM (e.g. bulk loads)
+# are indexed too. Prefixes of 2 and 3 characters are indexed to speed
+# up prefix queries, and item names weigh more in the ranking.
+SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS menu_search "
+    "USING fts5(name, description, restaurant_name, "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "INSERT INTO menu_search (menu_search, rank) "
+    "VALUES ('rank', 'bm25(4.0, 1.0, 2.0)')",
+    "CREATE TRIGGER IF NOT EXISTS menu_search_insert "
+    "AFTER INSERT ON menu_item BEGIN "
+    "INSERT INTO menu_search (rowid, name, description, restaurant_name) "
+    "SELECT new.id, new.name, new.description, "
+    "(SELECT name FROM restaurant WHERE id = new.restaurant_id); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS menu_search_update "
+    "AFTER UPDATE OF name, description, restaurant_id ON menu_item BEGIN "
+    "DELETE FROM menu_search WHERE rowid = old.id; "
+    "INSERT INTO menu_search (rowid, name, description, restaurant_name) "
+    "SELECT new.id, new.name, new.description, "
+    "(SELECT name FROM restaurant WHERE id = new.restaurant_id); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS menu_search_delete "
+    "AFTER DELETE ON menu_item BEGIN "
+    "DELETE FROM menu_search WHERE rowid = old.id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS menu_search_restaurant_update "
+    "AFTER UPDATE OF name ON restaurant BEGIN "
+    "UPDATE menu_search SET restaurant_name = new.name "
+    "WHERE rowid IN (SELECT id FROM menu_item "
+    "WHERE restaurant_id = new.id); "
+    "END",
+]
+for statement in SEARCH_DDL:
+    event.listen(Base.metadata, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
+# For queries: the virtual table is not part of the metadata, so that
+# create_all() does not try to create it as a regular table.
+menu_search = table('menu_search', column('rowid'), column('rank'))
+
+
 engine = create_engine('sqlite:///restaurantmenu.db')
 Base.metadata.create_all(engine)
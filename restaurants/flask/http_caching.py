@@ -0,0 +1,66 @@
+"""HTTP caching helpers: validators, conditional GET and Cache-Control."""
+
+import hashlib
+
+from flask import current_app, request, session, make_response
+
+
+def make_etag(*parts):
+    """Return a strong ETag value built from the given parts."""
+    key = '-'.join(str(part) for part in parts)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def has_flashes():
+    """Return whether there are flash messages waiting to be rendered."""
+    return bool(session.get('_flashes'))
+
+
+def is_fresh(etag, last_modified=None):
+    """Return whether the client's cached copy of a resource is fresh.
+
+    Pending flash messages are rendered into pages, so the cached copy
+    is never considered fresh while there are some.
+    """
+    if has_flashes():
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since:
+        # HTTP dates have a one-second resolution.
+        last_modified = last_modified.replace(microsecond=0)
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def not_modified(etag, last_modified=None, public=True):
+    """Return an empty 304 Not Modified response."""
+    response = current_app.response_class(status=304)
+    return cacheable(response, etag, last_modified, public)
+
+
+def cacheable(response, etag, last_modified=None, public=True):
+    """Add validators and Cache-Control headers to a response.
+
+    Parameters
+    ----------
+    response : Response or anything Flask views can return
+    etag : str
+    last_modified : datetime, optional
+        Naive UTC datetime.
+    public : bool
+        Whether shared caches (e.g. a CDN) may store the response for
+        app.config['CACHE_MAX_AGE'] seconds. Otherwise, only the browser
+        may store it and has to revalidate it on every use.
+    """
+    response = make_response(response)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if public:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['CACHE_MAX_AGE']
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
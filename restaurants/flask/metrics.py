@@ -0,0 +1,61 @@
+"""Request metrics of the Flask app, see request_metrics.py."""
+
+import os
+import sys
+
+from flask import Response, request
+from jinja2 import Template
+
+# request_metrics.py is shared with the webserver, one directory up.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from request_metrics import CONTENT_TYPE, Metrics  # noqa: E402,F401
+
+
+def instrument_app(app, metrics, engines):
+    """Record the metrics of a Flask app's requests.
+
+    Responses get a Server-Timing header, and metrics are served
+    on /metrics.
+
+    Parameters
+    ----------
+    app : Flask
+    metrics : Metrics
+    engines : list of Engine
+        Engines whose statements are attributed to requests.
+    """
+    for engine in engines:
+        metrics.instrument_engine(engine)
+
+    class TimedTemplate(Template):
+        def render(self, *args, **kwargs):
+            with metrics.rendering():
+                return super().render(*args, **kwargs)
+
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_request():
+        metrics.start()
+
+    @app.after_request
+    def finish_request(response):
+        timing = metrics.server_timing()
+        if timing is not None:
+            response.headers['Server-Timing'] = timing
+        # Unknown (None) for streamed responses.
+        size = response.calculate_content_length() or 0
+        metrics.finish(request.endpoint, request.method,
+                       response.status_code, size)
+        return response
+
+    @app.teardown_request
+    def finish_failed_request(exception=None):
+        # after_request hooks are skipped on unhandled exceptions.
+        if exception is not None:
+            metrics.finish(request.endpoint, request.method, 500, 0)
+
+    def show_metrics():
+        return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', show_metrics)
@@ -0,0 +1,149 @@
+"""Bring an existing restaurant database up to date with database_setup.
+
+Every migration is idempotent, so this script can be run on any
+database, whatever its age:
+
+    python migrate.py [--db sqlite:///restaurantmenu.db]
+
+Restaurant summaries can also be rebuilt from scratch, should they be
+out of date (e.g. after editing the database by hand):
+
+    python migrate.py --rebuild-summaries
+"""
+
+import argparse
+
+from sqlalchemy import create_engine, inspect, text
+
+from database_setup import Base, parse_price, SEARCH_DDL
+from database import rebuild_restaurant_summaries
+
+
+def get_columns(connection, table):
+    """Return the set of column names of a table."""
+    return {column['name']
+            for column in inspect(connection).get_columns(table)}
+
+
+def add_version_columns(connection):
+    """Add the version/updated_at columns used for HTTP caching."""
+    for table in ('restaurant', 'menu_item'):
+        columns = get_columns(connection, table)
+        if 'version' not in columns:
+            connection.execute(f'ALTER TABLE {table} '
+                               'ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+        if 'updated_at' not in columns:
+            # SQLite does not accept non-constant defaults here.
+            connection.execute(f'ALTER TABLE {table} '
+                               'ADD COLUMN updated_at DATETIME')
+            connection.execute(f'UPDATE {table} '
+                               'SET updated_at = CURRENT_TIMESTAMP')
+
+
+def add_price_cents(connection):
+    """Convert the textual menu item prices to integer cents.
+
+    Prices are cleaned up on the way (e.g. '$7.50' or 'btn-danger2.99').
+    The old `price` column is left in place but is no longer used.
+    """
+    columns = get_columns(connection, 'menu_item')
+    if 'price_cents' in columns:
+        return
+    connection.execute('ALTER TABLE menu_item ADD COLUMN price_cents INTEGER')
+    if 'price' in columns:
+        rows = connection.execute('SELECT id, price FROM menu_item').fetchall()
+        updates = [{'id': id_, 'price_cents': parse_price(price)}
+                   for id_, price in rows]
+        if updates:
+            connection.execute(text('UPDATE menu_item '
+                                    'SET price_cents = :price_cents '
+                                    'WHERE id = :id'), updates)
+
+
+def add_menu_item_indexes(connection):
+    """Index menu items by restaurant, and by restaurant and course."""
+    connection.execute('CREATE INDEX IF NOT EXISTS '
+                       'ix_menu_item_restaurant_id '
+                       'ON menu_item (restaurant_id)')
+    connection.execute('CREATE INDEX IF NOT EXISTS '
+                       'ix_menu_item_restaurant_id_course '
+                       'ON menu_item (restaurant_id, course)')
+
+
+def add_price_index(connection):
+    """Index menu items by price, for price range filters."""
+    connection.execute('CREATE INDEX IF NOT EXISTS '
+                       'ix_menu_item_price_cents '
+                       'ON menu_item (price_cents)')
+
+
+def add_search_index(connection):
+    """Create the full-text index of menu items, and fill it if needed."""
+    if connection.dialect.name != 'sqlite':
+        return
+    for statement in SEARCH_DDL:
+        connection.execute(statement)
+    indexed = connection.execute('SELECT count(*) FROM menu_search').scalar()
+    items = connection.execute('SELECT count(*) FROM menu_item').scalar()
+    if indexed != items:
+        rebuild_search_index(connection)
+
+
+def rebuild_search_index(connection):
+    """Index all menu items again."""
+    connection.execute('DELETE FROM menu_search')
+    connection.execute('INSERT INTO menu_search '
+                       '(rowid, name, description, restaurant_name) '
+                       'SELECT menu_item.id, menu_item.name, '
+                       'menu_item.description, restaurant.name '
+                       'FROM menu_item LEFT JOIN restaurant '
+                       'ON restaurant.id = menu_item.restaurant_id')
+
+
+def add_restaurant_summaries(connection):
+    """Create the summaries of the restaurants which have none."""
+    Base.metadata.tables['restaurant_summary'].create(connection,
+                                                      checkfirst=True)
+    missing = connection.execute(
+        'SELECT count(*) FROM restaurant WHERE id NOT IN '
+        '(SELECT restaurant_id FROM restaurant_summary)').scalar()
+    if missing:
+        rebuild_restaurant_summaries(connection)
+
+
+MIGRATIONS = [
+    add_version_columns,
+    add_price_cents,
+    add_menu_item_indexes,
+    add_price_index,
+    add_search_index,
+    add_restaurant_summaries,
+]
+
+
+def migrate(engine):
+    """Apply all migrations in a single transaction."""
+    with engine.begin() as connection:
+        for migration in MIGRATIONS:
+            print(f'Applying {migration.__name__}...')
+            migration(connection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='sqlite:///restaurantmenu.db',
+                        help='SQLAlchemy URI of the database to migrate.')
+    parser.add_argument('--rebuild-summaries', action='store_true',
+                        help='Compute all restaurant summaries again.')
+    args = parser.parse_args()
+    engine = create_engine(args.db)
+    migrate(engine)
+    print('Database is up to date.')
+    if args.rebuild_summaries:
+        with engine.begin() as connection:
+            count = rebuild_restaurant_summaries(connection)
+        print(f'Rebuilt the summaries of {count} restaurants.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""On-demand sampling profiler for requests.
+
+Profiles are collapsed stacks: one line per distinct stack, with its
+frames from outermost to innermost separated by semicolons, followed by
+the number of samples in which it was seen, e.g.
+
+    wsgi_app (app.py:1968);restaurant_detail (restaurants.py:170) 12
+
+which is the input format of flame graph tools.
+"""
+
+import os
+import sys
+import hmac
+import random
+import threading
+from collections import Counter, deque
+
+from flask import Response, request, g, abort
+
+
+class StackSampler:
+    """Sample the stack of a thread at regular intervals.
+
+    Sampling runs in a separate thread, so the profiled code is not
+    slowed down by tracing. Samples are only taken when the sampling
+    thread gets the GIL, i.e. about every `interval` seconds (or every
+    sys.getswitchinterval() seconds, if longer) while the profiled
+    thread is busy.
+
+    Parameters
+    ----------
+    thread_id : int
+        Identifier of the thread to profile, see threading.get_ident().
+    interval : float
+        Seconds between samples.
+    """
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and return the Counter of collapsed stacks."""
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+
+def collapse(frame):
+    """Return the stack ending with a frame, as a collapsed stack line."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:'
+                     f'{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def format_stacks(stacks):
+    """Return a Counter of collapsed stacks as text, most sampled first."""
+    return ''.join(f'{stack} {count}\n'
+                   for stack, count in stacks.most_common())
+
+
+class Profiler:
+    """Keep the profiles of the last requests.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between samples, see StackSampler.
+    history : int
+        Number of request profiles kept for the aggregate profile.
+    """
+
+    def __init__(self, interval=0.001, history=100):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # (endpoint, stacks) pairs.
+        self.profiles = deque(maxlen=history)
+
+    def sampler(self):
+        """Return a StackSampler for the current thread."""
+        return StackSampler(threading.get_ident(), self.interval)
+
+    def record(self, endpoint, stacks):
+        with self.lock:
+            self.profiles.append((endpoint, stacks))
+
+    def aggregate(self, endpoint=None):
+        """Return the sum of the kept profiles, optionally of one endpoint."""
+        total = Counter()
+        with self.lock:
+            profiles = list(self.profiles)
+        for profiled_endpoint, stacks in profiles:
+            if endpoint is None or profiled_endpoint == endpoint:
+                total.update(stacks)
+        return total
+
+
+def install_profiler(app, profiler, token=None, sample_rate=0):
+    """Profile a Flask app's requests.
+
+    A request is profiled on demand when it has a `profile=1` query
+    parameter or an `X-Profile: 1` header. Its response is then replaced
+    by its collapsed stacks. The aggregate profile of the last requests
+    is served on /debug/profile (`endpoint` query parameter to filter).
+
+    Both require the token in an `X-Profile-Token` header, unless the
+    app is in debug mode.
+
+    Parameters
+    ----------
+    app : Flask
+    profiler : Profiler
+    token : str, optional
+    sample_rate : float
+        Fraction of the other requests which are profiled into the
+        aggregate profile, from 0 (none) to 1 (all).
+    """
+    def authorized():
+        if token is None:
+            return app.debug
+        return hmac.compare_digest(request.headers.get('X-Profile-Token', ''),
+                                   token)
+
+    def requested():
+        return (request.args.get('profile') == '1'
+                or request.headers.get('X-Profile') == '1')
+
+    @app.before_request
+    def start_profile():
+        g.profile_requested = requested() and authorized()
+        if g.profile_requested or random.random() < sample_rate:
+            g.sampler = profiler.sampler()
+            g.sampler.start()
+
+    @app.after_request
+    def finish_profile(response):
+        sampler = g.pop('sampler', None)
+        if sampler is None:
+            return response
+        stacks = sampler.stop()
+        profiler.record(request.endpoint, stacks)
+        if g.profile_requested:
+            return Response(format_stacks(stacks), mimetype='text/plain')
+        return response
+
+    @app.teardown_request
+    def stop_profile(exception=None):
+        # after_request hooks are skipped on unhandled exceptions.
+        sampler = g.pop('sampler', None)
+        if sampler is not None:
+            sampler.stop()
+
+    def show_profile():
+        if not authorized():
+            abort(403)
+        stacks = profiler.aggregate(request.args.get('endpoint'))
+        return Response(format_stacks(stacks), mimetype='text/plain')
+
+    app.add_url_rule('/debug/profile', 'debug_profile', show_profile)
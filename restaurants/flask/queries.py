@@ -0,0 +1,147 @@
+"""Slow-query log and repeated (N+1) query detection."""
+
+import time
+import logging
+import threading
+from collections import Counter
+
+from flask import request
+from sqlalchemy import event
+
+
+logger = logging.getLogger('restaurants.queries')
+
+
+class QueryBudgetExceeded(Exception):
+    """A request executed more SQL statements than its budget allows."""
+
+
+class QueryInspector:
+    """Watch the SQL statements executed on engines.
+
+    Statements slower than `slow_threshold` are logged with their query
+    plan. Between start() and finish(), statements are also counted by
+    shape (the SQL text, without its parameters), so that the same query
+    run again and again, as when a template touches a lazy-loaded
+    relationship in a loop, can be reported.
+
+    Parameters
+    ----------
+    slow_threshold : float, optional
+        Seconds after which a statement is logged.
+    repeat_threshold : int, optional
+        Number of executions of the same statement, within a unit of
+        work, after which it is reported.
+    budget : int, optional
+        Maximum number of statements within a unit of work. Exceeding
+        it raises QueryBudgetExceeded, which fails the request: meant
+        for tests.
+    """
+
+    def __init__(self, slow_threshold=None, repeat_threshold=None,
+                 budget=None):
+        self.slow_threshold = slow_threshold
+        self.repeat_threshold = repeat_threshold
+        self.budget = budget
+        self.local = threading.local()
+
+    @property
+    def statements(self):
+        """Counter of this thread's statements, None outside a unit of work."""
+        return getattr(self.local, 'statements', None)
+
+    def start(self):
+        self.local.statements = Counter()
+
+    def finish(self, description):
+        """Report the repeated statements of this thread's unit of work.
+
+        Parameters
+        ----------
+        description : str
+            Identifies the unit of work (e.g. the request) in the logs.
+        """
+        statements = self.statements
+        if statements is None:
+            return
+        self.local.statements = None
+        if self.repeat_threshold is None:
+            return
+        for statement, count in statements.most_common():
+            if count <= self.repeat_threshold:
+                break
+            logger.warning('Possible N+1 query: %s executed %d times by %s',
+                           statement, count, description)
+
+    def instrument_engine(self, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(connection, cursor, statement, parameters,
+                                  context, executemany):
+            statements = self.statements
+            if statements is not None:
+                statements[statement] += 1
+                if self.budget is not None \
+                        and sum(statements.values()) > self.budget:
+                    raise QueryBudgetExceeded(
+                        f'More than {self.budget} SQL statements executed, '
+                        f'last one: {statement}')
+            connection.info.setdefault('inspector_start', []).append(
+                time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(connection, cursor, statement, parameters,
+                                 context, executemany):
+            elapsed = (time.perf_counter()
+                       - connection.info['inspector_start'].pop())
+            if self.slow_threshold is not None \
+                    and elapsed >= self.slow_threshold:
+                plan = None
+                if connection.dialect.name == 'sqlite' and not executemany:
+                    plan = explain(cursor.connection, statement, parameters)
+                logger.warning('Slow query (%.1fms): %s\nParameters: %r\n'
+                               'Query plan:\n%s', elapsed * 1000, statement,
+                               parameters, plan or '(not available)')
+
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(context):
+            # after_cursor_execute is skipped when a statement fails.
+            if context.connection is None:
+                return
+            starts = context.connection.info.get('inspector_start')
+            if starts:
+                starts.pop()
+
+
+def explain(dbapi_connection, statement, parameters):
+    """Return the EXPLAIN QUERY PLAN of a statement on SQLite, as text."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        # Rows are (id, parent, notused, detail).
+        return '\n'.join(f'{row[0]}|{row[1]}|{row[3]}'
+                         for row in cursor.fetchall())
+    except Exception as e:
+        return f'(failed: {e})'
+    finally:
+        cursor.close()
+
+
+def inspect_queries(app, inspector, engines):
+    """Watch the statements executed by a Flask app's requests.
+
+    Parameters
+    ----------
+    app : Flask
+    inspector : QueryInspector
+    engines : list of Engine
+    """
+    for engine in engines:
+        inspector.instrument_engine(engine)
+
+    @app.before_request
+    def start_request():
+        inspector.start()
+
+    @app.teardown_request
+    def finish_request(exception=None):
+        inspector.finish(f'{request.method} {request.path}')
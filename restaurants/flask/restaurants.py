@@ -1,32 +1,256 @@
 """Simple Flask project for restaurant menus."""
 
-from flask import Flask, render_template, request, redirect, url_for, flash, \
-    jsonify
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from database_setup import Base, Restaurant, MenuItem
-
+import re
+from datetime import datetime, timedelta
 
-def create_db():
-    """Create a database session and return it."""
-    engine = create_engine('sqlite:///restaurantmenu.db')
-    Base.metadata.bind = engine
-
-    DBSession = sessionmaker(bind=engine)
-    return DBSession()
+from flask import Flask, render_template, request, redirect, url_for, flash, \
+    jsonify, json, make_response, Response, stream_with_context, abort
+
+from database_setup import Restaurant, MenuItem, BulkRequest, parse_price
+from database import SQLITE_PERFORMANCE_PRAGMAS, create_db_engine, create_db, \
+    get_restaurant_version, get_restaurant_with_items, paginate_restaurants, \
+    iter_menus, make_match_query, search_items, filter_items, paginate_items, \
+    get_item_facets, get_items, touch_restaurant, bulk_write_items, \
+    paginate_restaurant_summaries, refresh_restaurant_summary
+from http_caching import make_etag, has_flashes, is_fresh, not_modified, \
+    cacheable
+from cache import create_cache
+from metrics import Metrics, instrument_app
+from queries import QueryInspector, inspect_queries
+from profiling import Profiler, install_profiler
 
 
 app = Flask(__name__)
 app.config['CURRENCY'] = '€'
-db = create_db()
+app.config.update(
+    DATABASE_URI='sqlite:///restaurantmenu.db',
+    DATABASE_POOL_SIZE=5,
+    DATABASE_MAX_OVERFLOW=10,
+    DATABASE_POOL_TIMEOUT=30,
+    DATABASE_POOL_RECYCLE=3600,
+    DATABASE_POOL_PRE_PING=True,
+    # Read-only views use a separate pool, by default on the same database.
+    DATABASE_READ_URI=None,
+    DATABASE_READ_POOL_SIZE=10,
+    # Pragmas run on every new SQLite connection. Use {} for defaults.
+    SQLITE_PRAGMAS=SQLITE_PERFORMANCE_PRAGMAS,
+    MENU_LOADER='joined',
+    PAGE_SIZE=50,
+    MAX_PAGE_SIZE=500,
+    EXPORT_BATCH_SIZE=1000,
+    # Maximum number of items fetched at once by id, or changed by a
+    # bulk write. They are bound in a single IN list: SQLite's default
+    # limit on the number of bound parameters is 999.
+    MAX_BATCH_SIZE=500,
+    # Seconds during which a bulk write can be repeated with the same
+    # Idempotency-Key without being applied again.
+    IDEMPOTENCY_KEY_TTL=24 * 3600,
+    CACHE_MAX_AGE=60,
+    CACHE_BACKEND='memory',
+    CACHE_OPTIONS={'maxsize': 1024, 'ttl': 300},
+    # Record request timings, add Server-Timing headers and serve
+    # the metrics on /metrics.
+    METRICS_ENABLED=False,
+    # Log statements slower than this many seconds, with their plan.
+    SLOW_QUERY_THRESHOLD=None,
+    # Log statements executed more than this many times by a request.
+    REPEATED_QUERY_THRESHOLD=None,
+    # Fail requests executing more statements than this. For tests.
+    QUERY_BUDGET=None,
+    # Profile requests with ?profile=1 or an X-Profile: 1 header, and
+    # serve the aggregate profile of the last ones on /debug/profile.
+    # Outside of debug mode, requires an X-Profile-Token header.
+    PROFILING_ENABLED=False,
+    PROFILING_TOKEN=None,
+    PROFILING_INTERVAL=0.001,
+    PROFILING_HISTORY=100,
+    # Fraction of all requests profiled into the aggregate profile.
+    PROFILING_SAMPLE_RATE=0,
+)
+# Deployments can override any of the above with a settings file.
+app.config.from_envvar('RESTAURANTS_SETTINGS', silent=True)
+
+engine = create_db_engine(
+    app.config['DATABASE_URI'],
+    pool_size=app.config['DATABASE_POOL_SIZE'],
+    max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+    pool_timeout=app.config['DATABASE_POOL_TIMEOUT'],
+    pool_recycle=app.config['DATABASE_POOL_RECYCLE'],
+    pool_pre_ping=app.config['DATABASE_POOL_PRE_PING'],
+    pragmas=app.config['SQLITE_PRAGMAS'],
+)
+db = create_db(engine)
+read_engine = create_db_engine(
+    app.config['DATABASE_READ_URI'] or app.config['DATABASE_URI'],
+    pool_size=app.config['DATABASE_READ_POOL_SIZE'],
+    max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+    pool_timeout=app.config['DATABASE_POOL_TIMEOUT'],
+    pool_recycle=app.config['DATABASE_POOL_RECYCLE'],
+    pool_pre_ping=app.config['DATABASE_POOL_PRE_PING'],
+    pragmas=app.config['SQLITE_PRAGMAS'],
+    read_only=True,
+)
+# Session for views which only read, so that they never wait for
+# a connection held by a write.
+read_db = create_db(read_engine)
+# Use the 'sqlite' backend with a 'path' option to share the cache
+# between the worker processes of a server.
+cache = create_cache(app.config['CACHE_BACKEND'],
+                     **app.config['CACHE_OPTIONS'])
+metrics = None
+if app.config['METRICS_ENABLED']:
+    metrics = Metrics()
+    instrument_app(app, metrics, [engine, read_engine])
+if any(app.config[name] is not None for name in (
+        'SLOW_QUERY_THRESHOLD', 'REPEATED_QUERY_THRESHOLD', 'QUERY_BUDGET')):
+    inspect_queries(app, QueryInspector(app.config['SLOW_QUERY_THRESHOLD'],
+                                        app.config['REPEATED_QUERY_THRESHOLD'],
+                                        app.config['QUERY_BUDGET']),
+                    [engine, read_engine])
+if app.config['PROFILING_ENABLED']:
+    install_profiler(app, Profiler(app.config['PROFILING_INTERVAL'],
+                                   app.config['PROFILING_HISTORY']),
+                     app.config['PROFILING_TOKEN'],
+                     app.config['PROFILING_SAMPLE_RATE'])
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Release the request's session and return its connection to the pool.
+
+    Uncommitted work (e.g. after a failed commit) is rolled back so that
+    it does not leak into later requests.
+    """
+    db.remove()
+    read_db.remove()
+
+
+def get_limit():
+    """Return the page size requested by `limit`, within bounds."""
+    limit = request.args.get('limit', app.config['PAGE_SIZE'], type=int)
+    return min(max(limit, 1), app.config['MAX_PAGE_SIZE'])
+
+
+def get_page(columns=None):
+    """Return the page of restaurants requested by `limit` and `after`.
+
+    Return a (restaurants, next_cursor, limit) tuple,
+    see paginate_restaurants().
+    """
+    limit = get_limit()
+    after = request.args.get('after', type=int)
+    restaurants, cursor = paginate_restaurants(read_db, limit, after, columns)
+    return restaurants, cursor, limit
+
+
+def get_menu_item(session, restaurant_id, item_id):
+    """Return an item of a restaurant's menu, or abort with a 404.
+
+    Items of other restaurants are not found, so that views always
+    touch the restaurant the item belongs to.
+    """
+    item = (session.query(MenuItem)
+            .filter_by(id=item_id, restaurant_id=restaurant_id)
+            .first())
+    if item is None:
+        abort(404)
+    return item
+
+
+# Query parameters filtering menu items.
+ITEM_FILTERS = ('course', 'min_price', 'max_price')
+PRICE_FILTER = re.compile(r'\d+\.?\d*|\.\d+')
+
+
+def get_item_filters():
+    """Return the menu item filters given in the query parameters.
+
+    `course` may be repeated, prices are decimals (e.g. `max_price=9.99`).
+    Abort with a 400 response if a price is not a non-negative decimal.
+    See database.filter_items().
+    """
+    filters = {'courses': request.args.getlist('course')}
+    for name in ('min_price', 'max_price'):
+        value = request.args.get(name, '').strip()
+        if value and PRICE_FILTER.fullmatch(value) is None:
+            abort(make_response(jsonify(
+                error=f'{name} must be a non-negative decimal.'), 400))
+        filters[name] = parse_price(value)
+    return filters
+
+
+def menu_response(view, restaurant_id, render, public=True):
+    """Return the menu of a restaurant rendered by a view.
+
+    Responses are cached by view, restaurant version and currency,
+    along with their validators, so that only the version of the
+    restaurant is read while the cached copy is valid. Since every
+    change bumps the version, a menu rendered before a change can never
+    be served after it, even if it is stored into the cache once the
+    change is committed. Pages are neither served from nor stored into
+    the cache while flash messages are pending.
+
+    Parameters
+    ----------
+    view : str
+        Name of the view, used in the cache key.
+    restaurant_id : int
+    render : callable
+        Called with the restaurant (and its items loaded) on a cache
+        miss. Must return anything that Flask views can return.
+    public : bool
+        See http_caching.cacheable().
+    """
+    version, updated_at = get_restaurant_version(read_db, restaurant_id)
+    etag = make_etag('restaurant', restaurant_id, version)
+    if is_fresh(etag, updated_at):
+        return not_modified(etag, updated_at, public)
+    use_cache = not has_flashes()
+    cached = None
+    if use_cache:
+        cached = cache.get(
+            menu_cache_key(view, restaurant_id, version, updated_at))
+    if cached is None:
+        restaurant = get_restaurant_with_items(read_db, restaurant_id,
+                                               app.config['MENU_LOADER'])
+        response = make_response(render(restaurant))
+        # The restaurant may have changed since its version was read.
+        etag = make_etag('restaurant', restaurant.id, restaurant.version)
+        cached = (response.get_data(), response.mimetype, etag,
+                  restaurant.updated_at)
+        if use_cache:
+            cache.set(menu_cache_key(view, restaurant.id, restaurant.version,
+                                     restaurant.updated_at), cached)
+    data, mimetype, etag, updated_at = cached
+    response = app.response_class(data, mimetype=mimetype)
+    return cacheable(response, etag, updated_at, public)
+
+
+def menu_cache_key(view, restaurant_id, version, updated_at):
+    """Return the cache key of a restaurant's menu rendered by a view.
+
+    The modification time tells apart a deleted restaurant from a new
+    one reusing its id.
+    """
+    return (f'menu:{view}:{restaurant_id}:{version}:'
+            f'{updated_at.isoformat()}:{app.config["CURRENCY"]}')
 
 
 @app.route('/')
 def index():
-    """Home page, with a list of all restaurants."""
-    restaurants = db.query(Restaurant).all()
-    return render_template('index.html', restaurants=restaurants)
+    """Home page, with a paginated list of restaurants.
+
+    Restaurants are listed with the summary of their menus, read in the
+    same query.
+    """
+    limit = get_limit()
+    restaurants, cursor = paginate_restaurant_summaries(
+        read_db, limit, request.args.get('after', type=int))
+    next_url = None
+    if cursor is not None:
+        next_url = url_for('index', after=cursor, limit=limit)
+    return render_template('index.html', restaurants=restaurants,
+                           next_url=next_url)
 
 
 # Restaurant CRUD
@@ -34,10 +258,12 @@ def index():
 @app.route('/restaurants/<int:restaurant_id>/')
 def restaurant_detail(restaurant_id):
     """Detail page of a restaurant."""
-    restaurant = db.query(Restaurant).filter_by(id=restaurant_id).one()
-    items = db.query(MenuItem).filter_by(restaurant=restaurant).all()
-    return render_template('restaurant_detail.html', restaurant=restaurant,
-                           items=items)
+    def render(restaurant):
+        return render_template('restaurant_detail.html',
+                               restaurant=restaurant, items=restaurant.items)
+
+    return menu_response('restaurant_detail', restaurant_id, render,
+                         public=False)
 
 
 @app.route('/restaurants/add/', methods=['GET', 'POST'])
@@ -47,6 +273,9 @@ def add_restaurant():
         name = request.form['name']
         restaurant = Restaurant(name=name)
         db.add(restaurant)
+        # Assigns the restaurant's id.
+        db.flush()
+        refresh_restaurant_summary(db, restaurant.id)
         db.commit()
         flash(f'Successfully created restaurant {restaurant.name}.')
         return redirect(url_for('index'))
@@ -60,6 +289,7 @@ def edit_restaurant(restaurant_id):
     if request.method == 'POST':
         name = request.form['name']
         restaurant.name = name
+        restaurant.touch()
         db.add(restaurant)
         db.commit()
         flash(f'Successfully editted {restaurant.name}.')
@@ -73,6 +303,7 @@ def delete_restaurant(restaurant_id):
     """Delete a restaurant."""
     restaurant = db.query(Restaurant).filter_by(id=restaurant_id).one()
     if request.method == 'POST':
+        # Also deletes its items and summary.
         db.delete(restaurant)
         db.commit()
         flash(f'{restaurant.name} successfully deleted.')
@@ -97,7 +328,9 @@ def add_item(restaurant_id):
                         description=description,
                         course=course,
                         restaurant=restaurant)
+        restaurant.touch()
         db.add(item)
+        refresh_restaurant_summary(db, restaurant_id)
         db.commit()
         flash(f'Successfully added {item.name}.')
         return redirect(url_for('restaurant_detail',
@@ -110,13 +343,16 @@ def add_item(restaurant_id):
 def edit_item(restaurant_id, item_id):
     """Edit an item of a restaurant's menu."""
     restaurant = db.query(Restaurant).filter_by(id=restaurant_id).one()
-    item = db.query(MenuItem).filter_by(id=item_id).one()
+    item = get_menu_item(db, restaurant_id, item_id)
     if request.method == 'POST':
         item.name = request.form['name']
         item.price = request.form['price']
         item.description = request.form['description']
-        request.course = request.form['course']
+        item.course = request.form['course']
+        item.touch()
+        restaurant.touch()
         db.add(item)
+        refresh_restaurant_summary(db, restaurant_id)
         db.commit()
         flash(f'{item.name} successfully edited.')
         return redirect(url_for('restaurant_detail',
@@ -129,9 +365,11 @@ def edit_item(restaurant_id, item_id):
 def delete_item(restaurant_id, item_id):
     """Delete an item from a restaurant's menu."""
     restaurant = db.query(Restaurant).filter_by(id=restaurant_id).one()
-    item = db.query(MenuItem).filter_by(id=item_id).one()
+    item = get_menu_item(db, restaurant_id, item_id)
     if request.method == 'POST':
         db.delete(item)
+        restaurant.touch()
+        refresh_restaurant_summary(db, restaurant_id)
         db.commit()
         flash(f'{item.name} successfully deleted.')
         return redirect(url_for('restaurant_detail',
@@ -144,26 +382,282 @@ def delete_item(restaurant_id, item_id):
 
 @app.route('/api/restaurants/')
 def api_restaurants():
-    """API endpoint to GET all the restaurants."""
-    restaurants = db.query(Restaurant).all()
-    return jsonify(restaurants=[restaurant.serialized
-                                for restaurant in restaurants])
+    """API endpoint to GET a page of restaurants.
+
+    Query parameters: `limit` (page size) and `after` (cursor returned
+    as `next` by the previous page).
+    """
+    rows, cursor, limit = get_page([Restaurant.id, Restaurant.version,
+                                    Restaurant.updated_at])
+    etag = make_etag(limit, *((row.id, row.version) for row in rows))
+    last_modified = max((row.updated_at for row in rows), default=None)
+    if is_fresh(etag, last_modified):
+        return not_modified(etag, last_modified)
+
+    # Serialized restaurants are cached by version, so they never need
+    # to be invalidated. Fetch them all at once, then load the missing
+    # ones with a single query.
+    keys = {row.id: f'restaurant:{row.id}:{row.version}' for row in rows}
+    serialized = cache.get_many(keys.values())
+    missing = [id_ for id_, key in keys.items() if key not in serialized]
+    if missing:
+        loaded = {keys[restaurant.id]: restaurant.serialized
+                  for restaurant in read_db.query(Restaurant)
+                  .filter(Restaurant.id.in_(missing))}
+        cache.set_many(loaded)
+        serialized.update(loaded)
+
+    next_url = None
+    if cursor is not None:
+        next_url = url_for('api_restaurants', after=cursor, limit=limit,
+                           _external=True)
+    # Skip restaurants deleted since the page was read.
+    response = jsonify(restaurants=[serialized[key] for key in keys.values()
+                                    if key in serialized],
+                       next=next_url)
+    return cacheable(response, etag, last_modified)
 
 
 @app.route('/api/restaurants/<int:restaurant_id>/')
 def api_restaurant_detail(restaurant_id):
-    """API endpoint to GET the menu of a restaurant."""
-    restaurant = db.query(Restaurant).filter_by(id=restaurant_id).one()
-    items = db.query(MenuItem).filter_by(restaurant=restaurant)
-    return jsonify(name=restaurant.name,
-                   items=[item.serialized for item in items])
+    """API endpoint to GET the menu of a restaurant.
+
+    The menu can be filtered with `course`, `min_price` and `max_price`
+    query parameters, in which case the response also has the `facets`
+    of the menu (see database.get_item_facets()).
+    """
+    if any(name in request.args for name in ITEM_FILTERS):
+        filters = get_item_filters()
+        restaurant = (read_db.query(Restaurant)
+                      .filter_by(id=restaurant_id)
+                      .one())
+        items = (filter_items(read_db.query(MenuItem), restaurant_id,
+                              **filters)
+                 .order_by(MenuItem.id)
+                 .all())
+        return jsonify(name=restaurant.name,
+                       items=[item.serialized for item in items],
+                       facets=get_item_facets(read_db, restaurant_id,
+                                              **filters))
+
+    def render(restaurant):
+        return jsonify(name=restaurant.name,
+                       items=[item.serialized for item in restaurant.items])
+
+    return menu_response('api_restaurant_detail', restaurant_id, render)
+
+
+@app.route('/api/restaurants/<int:restaurant_id>/items/bulk/',
+           methods=['POST'])
+def api_bulk_items(restaurant_id):
+    """API endpoint to create, update and delete many items of a menu.
+
+    Expects a JSON object with an `upsert` list of items (see
+    database.parse_item_change()) and a `delete` list of item ids.
+    Changes are applied in a single transaction, or not at all if any
+    of them is invalid (400). There can be at most MAX_BATCH_SIZE of
+    them. The response lists the `results` of the changes, see
+    database.bulk_write_items().
+
+    Requests with an `Idempotency-Key` header can be safely retried:
+    once a request is applied, the same response is sent back to the
+    next ones with the same key, without applying them again.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) \
+            or not isinstance(data.get('upsert', []), list) \
+            or not isinstance(data.get('delete', []), list):
+        return jsonify(error='Expected a JSON object with upsert '
+                             'and delete lists.'), 400
+    if len(data.get('upsert', [])) + len(data.get('delete', [])) \
+            > app.config['MAX_BATCH_SIZE']:
+        return jsonify(error='Too many changes, the maximum is '
+                             f'{app.config["MAX_BATCH_SIZE"]}.'), 400
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= 250:
+        return jsonify(error='Invalid Idempotency-Key.'), 400
+
+    # Lock the database for writes first, so that repeated requests
+    # are applied one after the other.
+    if not touch_restaurant(db, restaurant_id):
+        db.rollback()
+        return jsonify(error='No such restaurant.'), 404
+    if key is not None:
+        applied = db.query(BulkRequest).get(key)
+        if applied is not None:
+            db.rollback()
+            if applied.restaurant_id != restaurant_id:
+                return jsonify(error='Idempotency-Key already used for '
+                                     'another restaurant.'), 422
+            response = app.response_class(applied.response,
+                                          mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+    results, valid = bulk_write_items(db, restaurant_id,
+                                      data.get('upsert', []),
+                                      data.get('delete', []))
+    if not valid:
+        db.rollback()
+        return jsonify(results=results), 400
+    refresh_restaurant_summary(db, restaurant_id)
+    response = jsonify(results=results)
+    if key is not None:
+        expired = datetime.utcnow() - timedelta(
+            seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+        (db.query(BulkRequest)
+         .filter(BulkRequest.created_at < expired)
+         .delete(synchronize_session=False))
+        db.add(BulkRequest(key=key, restaurant_id=restaurant_id,
+                           response=response.get_data(as_text=True)))
+    db.commit()
+    return response
 
 
 @app.route('/api/restaurants/<int:restaurant_id>/items/<int:item_id>/')
 def api_item(restaurant_id, item_id):
     """API endpoint to GET an item from a restaurant's menu."""
-    item = db.query(MenuItem).filter_by(id=item_id).one()
-    return jsonify(item=item.serialized)
+    item = get_menu_item(read_db, restaurant_id, item_id)
+    etag = make_etag('item', item.id, item.version)
+    if is_fresh(etag, item.updated_at):
+        return not_modified(etag, item.updated_at)
+    return cacheable(jsonify(item=item.serialized), etag, item.updated_at)
+
+
+@app.route('/api/search/')
+def api_search():
+    """API endpoint to search menu items.
+
+    Query parameters: `q` (words to look for in the names and
+    descriptions of items and the names of restaurants, as prefixes),
+    `limit` and `offset`. Results are ranked by relevance.
+    """
+    match_query = make_match_query(request.args.get('q', ''))
+    if match_query is None:
+        return jsonify(error='Missing search terms (q).'), 400
+    limit = get_limit()
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    results, more = search_items(read_db, match_query, limit, offset)
+
+    items = []
+    for item, restaurant in results:
+        data = item.serialized
+        data['restaurant'] = restaurant.serialized
+        items.append(data)
+    next_url = None
+    if more:
+        next_url = url_for('api_search', q=request.args['q'], limit=limit,
+                           offset=offset + limit, _external=True)
+    return jsonify(items=items, next=next_url)
+
+
+@app.route('/api/items/', methods=['GET', 'POST'])
+def api_items():
+    """API endpoint to GET menu items across restaurants.
+
+    Query parameters: `restaurant` (id), `course`, `min_price` and
+    `max_price` to filter items, `limit` and `after` (cursor returned
+    as `next` by the previous page). The response also has the `facets`
+    of all the filtered items (see database.get_item_facets()).
+
+    Many items can also be fetched at once by id, with an `ids`
+    parameter (e.g. `ids=1,2,3`) or by POSTing a JSON object with an
+    `ids` list and an optional `restaurant`, see items_by_id().
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('ids'),
+                                                        list):
+            return jsonify(error='Expected a JSON object with ids.'), 400
+        return items_by_id(data['ids'], data.get('restaurant'))
+    if 'ids' in request.args:
+        # Left as strings if they are not integers, and rejected.
+        ids = [int(id_) if id_.isdecimal() else id_
+               for id_ in request.args['ids'].split(',') if id_]
+        restaurant_id = request.args.get('restaurant')
+        if restaurant_id is not None and restaurant_id.isdecimal():
+            restaurant_id = int(restaurant_id)
+        return items_by_id(ids, restaurant_id)
+
+    restaurant_id = request.args.get('restaurant', type=int)
+    filters = get_item_filters()
+    limit = get_limit()
+    items, cursor = paginate_items(
+        filter_items(read_db.query(MenuItem), restaurant_id, **filters),
+        limit, request.args.get('after', type=int))
+
+    next_url = None
+    if cursor is not None:
+        args = request.args.to_dict(flat=False)
+        args.update(after=cursor, limit=limit)
+        next_url = url_for('api_items', _external=True, **args)
+    return jsonify(items=[dict(item.serialized,
+                               restaurant_id=item.restaurant_id)
+                          for item in items],
+                   facets=get_item_facets(read_db, restaurant_id, **filters),
+                   next=next_url)
+
+
+def is_id(value):
+    """Whether a value (e.g. decoded from JSON) is an integer id."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def items_by_id(ids, restaurant_id=None):
+    """Return the response to a request for many items by id.
+
+    The items are loaded with a single query and returned as `items`,
+    keyed by id, along with the list of `missing` ids. If a restaurant
+    is given, requesting items of other restaurants is an error.
+    Ids must be ints, not strings, floats or booleans.
+    """
+    if not all(is_id(id_) for id_ in ids) \
+            or (restaurant_id is not None and not is_id(restaurant_id)):
+        return jsonify(error='Ids must be integers.'), 400
+    if len(ids) > app.config['MAX_BATCH_SIZE']:
+        return jsonify(error='Too many ids, the maximum is '
+                             f'{app.config["MAX_BATCH_SIZE"]}.'), 400
+
+    items = get_items(read_db, ids)
+    if restaurant_id is not None:
+        foreign = sorted(item.id for item in items
+                         if item.restaurant_id != restaurant_id)
+        if foreign:
+            return jsonify(error='Items do not belong to restaurant '
+                                 f'{restaurant_id}.', ids=foreign), 400
+    found = {item.id: item for item in items}
+    return jsonify(
+        items={str(id_): dict(item.serialized,
+                              restaurant_id=item.restaurant_id)
+               for id_, item in found.items()},
+        missing=sorted(set(ids) - found.keys()),
+    )
+
+
+@app.route('/api/export/')
+def api_export():
+    """API endpoint to GET every restaurant and its menu.
+
+    The response is streamed as newline-delimited JSON, one restaurant
+    (with its `items`) per line.
+    """
+    def generate():
+        menus = iter_menus(read_db, app.config['EXPORT_BATCH_SIZE'])
+        for restaurant, items in menus:
+            data = restaurant.serialized
+            data['items'] = [item.serialized for item in items]
+            yield json.dumps(data) + '\n'
+
+    # Keep the request context (and thus the session) alive while
+    # the response is being streamed.
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/api/cache/')
+def api_cache_stats():
+    """API endpoint to GET the hit/miss/eviction counters of the cache."""
+    return jsonify(backend=app.config['CACHE_BACKEND'], **cache.stats)
 
 
 # Context processors
@@ -188,6 +682,8 @@ def utilities():
         format_price(2.6, '£') -> £2.60
         format_price(.99, '$') -> $0.99
         """
+        if amount is None:
+            return ''
         if currency is None:
             currency = get_currency()
         amount = float(amount)
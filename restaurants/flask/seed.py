@@ -0,0 +1,155 @@
+"""Load restaurants and menus into the database, in bulk.
+
+Restaurants come either from a fixture file or from a generator of
+synthetic menus (useful for load testing):
+
+    python seed.py fixtures/menus.json
+    python seed.py --synthetic 10000 --items 100 --batch-size 50000
+
+Fixtures can be JSON (a list of restaurants, each with a list of
+`items`), NDJSON (one such restaurant per line, as produced by
+/api/export/) or CSV (one item per row, with a `restaurant` column).
+"""
+
+import os
+import csv
+import json
+import random
+import argparse
+from itertools import groupby
+
+from sqlalchemy import create_engine, select, func
+
+from database_setup import Base, Restaurant, MenuItem, parse_price
+from database import rebuild_restaurant_summaries
+
+
+ITEM_FIELDS = ('name', 'course', 'description', 'price')
+COURSES = ('Appetizer', 'Entree', 'Dessert', 'Beverage')
+DISHES = ('Burger', 'Ramen', 'Salad', 'Curry', 'Burrito', 'Pho', 'Risotto',
+          'Tart', 'Dumplings', 'Sorbet', 'Lemonade', 'Iced Tea')
+ADJECTIVES = ('Spicy', 'Grilled', 'Veggie', 'Classic', 'Smoked', 'Crispy',
+              'Homemade', 'Seasonal', 'Sweet', 'Fresh')
+
+
+def iter_fixture(path):
+    """Yield restaurants, as dicts with a list of `items`, from a file."""
+    extension = os.path.splitext(path)[1]
+    with open(path, newline='', encoding='utf-8') as f:
+        if extension == '.json':
+            yield from json.load(f)
+        elif extension == '.ndjson':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif extension == '.csv':
+            rows = csv.DictReader(f)
+            for name, items in groupby(rows,
+                                       key=lambda row: row['restaurant']):
+                yield {
+                    'name': name,
+                    'items': [{field: item.get(field) for field in ITEM_FIELDS}
+                              for item in items if item.get('name')],
+                }
+        else:
+            raise ValueError(f'Unsupported fixture format: {path}')
+
+
+def iter_synthetic(restaurants, items, seed=None):
+    """Yield synthetic restaurants, with `items` random items each."""
+    rng = random.Random(seed)
+    for number in range(1, restaurants + 1):
+        yield {
+            'name': f'Restaurant #{number}',
+            'items': [{
+                'name': f'{rng.choice(ADJECTIVES)} {rng.choice(DISHES)}',
+                'course': rng.choice(COURSES),
+                'description': 'Generated for load testing',
+                'price': f'{rng.randint(99, 2999) / 100:.2f}',
+            } for _ in range(items)],
+        }
+
+
+def bulk_load(engine, restaurants, batch_size=10000):
+    """Insert restaurants and their items, and return how many of each.
+
+    Rows are inserted with executemany, in one transaction per batch of
+    about `batch_size` rows. Restaurant ids are assigned here so that
+    items can reference them without reading them back, which assumes
+    nothing else writes restaurants meanwhile. Restaurant summaries are
+    rebuilt once everything is loaded, which is cheaper than maintaining
+    them row by row during the load.
+    """
+    restaurant_table = Restaurant.__table__
+    item_table = MenuItem.__table__
+    with engine.connect() as connection:
+        last_id = connection.execute(
+            select([func.max(restaurant_table.c.id)])).scalar() or 0
+
+    restaurant_rows, item_rows = [], []
+    restaurant_count = item_count = 0
+
+    def flush():
+        with engine.begin() as connection:
+            if restaurant_rows:
+                connection.execute(restaurant_table.insert(), restaurant_rows)
+            if item_rows:
+                connection.execute(item_table.insert(), item_rows)
+        restaurant_rows.clear()
+        item_rows.clear()
+
+    for restaurant in restaurants:
+        last_id += 1
+        restaurant_rows.append({'id': last_id, 'name': restaurant['name']})
+        for item in restaurant.get('items', []):
+            row = {field: item.get(field) for field in ITEM_FIELDS}
+            row['price_cents'] = parse_price(row.pop('price'))
+            row['restaurant_id'] = last_id
+            item_rows.append(row)
+        restaurant_count += 1
+        item_count += len(restaurant.get('items', []))
+        if len(restaurant_rows) + len(item_rows) >= batch_size:
+            flush()
+            print(f'{restaurant_count} restaurants, {item_count} items...')
+    flush()
+    with engine.begin() as connection:
+        rebuild_restaurant_summaries(connection)
+    return restaurant_count, item_count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.splitlines()[2:]))
+    parser.add_argument('fixture', nargs='?',
+                        help='JSON, NDJSON or CSV file to load.')
+    parser.add_argument('--synthetic', type=int, metavar='N',
+                        help='Generate N synthetic restaurants instead.')
+    parser.add_argument('--items', type=int, default=20,
+                        help='Items per synthetic restaurant (default: 20).')
+    parser.add_argument('--random-seed', type=int,
+                        help='Seed of the synthetic generator.')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='Rows per transaction (default: 10000).')
+    parser.add_argument('--db', default='sqlite:///restaurantmenu.db',
+                        help='SQLAlchemy URI of the database to seed.')
+    args = parser.parse_args()
+
+    if args.synthetic is not None:
+        restaurants = iter_synthetic(args.synthetic, args.items,
+                                     args.random_seed)
+    elif args.fixture is not None:
+        restaurants = iter_fixture(args.fixture)
+    else:
+        parser.error('a fixture or --synthetic is required')
+
+    engine = create_engine(args.db)
+    Base.metadata.create_all(engine)
+    restaurant_count, item_count = bulk_load(engine, restaurants,
+                                             args.batch_size)
+    print(f'Added {restaurant_count} restaurants and {item_count} items!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Per-request timings and SQL statistics, exported for Prometheus.
+
+Shared by the Flask app and the webserver, whose metrics.py modules
+hook it into their requests. Metrics are kept in memory, per process:
+with several worker processes, each one exports its own.
+"""
+
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+DURATION_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                    2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Counts of observed values in cumulative buckets."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Yield the (name, labels, value) samples of the histogram."""
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket', dict(labels, le=str(bound)), cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+class RequestStats:
+    """Timings of the request being handled."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.
+        self.render_time = 0.
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+def escape_label(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def format_sample(name, labels, value):
+    labels = ','.join(f'{key}="{escape_label(label)}"'
+                      for key, label in labels.items())
+    return f'{name}{{{labels}}} {value}'
+
+
+class Metrics:
+    """Collect request metrics.
+
+    Call start() when a request comes in and finish() once it has been
+    responded to, from the thread handling it. SQL statements run in
+    between on instrumented engines are attributed to the request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Keyed by (endpoint, method, status).
+        self.requests = {}
+        # Keyed by endpoint.
+        self.durations = {}
+        self.sql_statements = {}
+        self.sql_durations = {}
+        self.render_durations = {}
+        self.sizes = {}
+
+    @property
+    def current(self):
+        """The RequestStats of this thread's request, or None."""
+        return getattr(self.local, 'request', None)
+
+    def start(self):
+        self.local.request = RequestStats()
+
+    def instrument_engine(self, engine):
+        """Count the statements run on an engine and time them."""
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(connection, cursor, statement, parameters,
+                                  context, executemany):
+            connection.info.setdefault('query_start', []).append(
+                time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(connection, cursor, statement, parameters,
+                                 context, executemany):
+            start = connection.info['query_start'].pop()
+            request = self.current
+            if request is not None:
+                request.sql_count += 1
+                request.sql_time += time.perf_counter() - start
+
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(context):
+            # after_cursor_execute is skipped when a statement fails.
+            if context.connection is None:
+                return
+            starts = context.connection.info.get('query_start')
+            if starts:
+                starts.pop()
+
+    @contextmanager
+    def rendering(self):
+        """Context manager timing the rendering of a response."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            request = self.current
+            if request is not None:
+                request.render_time += time.perf_counter() - start
+
+    def server_timing(self):
+        """Return the Server-Timing header value of this thread's request."""
+        request = self.current
+        if request is None:
+            return None
+        return (f'app;dur={request.elapsed * 1000:.1f}, '
+                f'db;dur={request.sql_time * 1000:.1f};'
+                f'desc="{request.sql_count} queries", '
+                f'render;dur={request.render_time * 1000:.1f}')
+
+    def finish(self, endpoint, method, status, size):
+        """Record this thread's request once it has been responded to.
+
+        Parameters
+        ----------
+        endpoint : str
+            Name of the view or handler, None if no route matched.
+        method : str
+        status : int
+        size : int
+            Size in bytes of the response body.
+        """
+        request = self.current
+        if request is None:
+            return
+        self.local.request = None
+        elapsed = request.elapsed
+        endpoint = endpoint or 'unmatched'
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.durations.setdefault(
+                endpoint, Histogram(DURATION_BUCKETS)).observe(elapsed)
+            self.sql_statements[endpoint] = \
+                self.sql_statements.get(endpoint, 0) + request.sql_count
+            self.sql_durations.setdefault(
+                endpoint, Histogram(DURATION_BUCKETS)).observe(
+                    request.sql_time)
+            self.render_durations[endpoint] = \
+                self.render_durations.get(endpoint, 0) + request.render_time
+            self.sizes.setdefault(
+                endpoint, Histogram(SIZE_BUCKETS)).observe(size)
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+
+        def add(name, kind, help, samples):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(format_sample(*sample) for sample in samples)
+
+        def histograms(name, histograms):
+            for endpoint, histogram in sorted(histograms.items()):
+                yield from histogram.samples(name, {'endpoint': endpoint})
+
+        with self.lock:
+            add('http_requests_total', 'counter', 'Requests handled.',
+                ((('http_requests_total',
+                   {'endpoint': endpoint, 'method': method,
+                    'status': status}, count))
+                 for (endpoint, method, status), count
+                 in sorted(self.requests.items(), key=str)))
+            add('http_request_duration_seconds', 'histogram',
+                'Wall time spent handling requests.',
+                histograms('http_request_duration_seconds', self.durations))
+            add('sql_statements_total', 'counter',
+                'SQL statements executed by requests.',
+                (('sql_statements_total', {'endpoint': endpoint}, count)
+                 for endpoint, count in sorted(self.sql_statements.items())))
+            add('sql_duration_seconds', 'histogram',
+                'Time per request spent executing SQL statements.',
+                histograms('sql_duration_seconds', self.sql_durations))
+            add('render_duration_seconds_total', 'counter',
+                'Time spent rendering templates.',
+                (('render_duration_seconds_total', {'endpoint': endpoint},
+                  seconds)
+                 for endpoint, seconds
+                 in sorted(self.render_durations.items())))
+            add('http_response_size_bytes', 'histogram',
+                'Size of response bodies.',
+                histograms('http_response_size_bytes', self.sizes))
+        return '\n'.join(lines) + '\n'
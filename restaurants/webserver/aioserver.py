@@ -0,0 +1,181 @@
+"""asyncio engine for the webserver's routes.
+
+Connections are handled by a single event loop, so that idle keep-alive
+connections cost no thread. Each request is then run by the usual
+WebServerHandler in a bounded pool of threads, where database work
+happens. It serves the same URLs as webserver.py:
+
+    python aioserver.py [--port 8080] [--threads 8] [--metrics]
+"""
+
+import io
+import signal
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from webserver import WebServerHandler, enable_metrics
+from forms import MAX_BODY_SIZE
+
+
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class RequestError(Exception):
+    """The request cannot be handled. Its argument is the response."""
+
+
+class BufferedRequestHandler(WebServerHandler):
+    """WebServerHandler processing a request already read in memory."""
+
+    def __init__(self, data, client_address):
+        # Skip the socket-based setup of StreamRequestHandler.
+        self.rfile = io.BytesIO(data)
+        self.wfile = io.BytesIO()
+        self.client_address = client_address
+        self.close_connection = True
+
+    def run(self):
+        """Handle the request.
+
+        Return the response as bytes, and whether the connection can
+        be kept alive.
+        """
+        self.handle_one_request()
+        return self.wfile.getvalue(), not self.close_connection
+
+
+def run_handler(data, client_address):
+    return BufferedRequestHandler(data, client_address).run()
+
+
+async def read_request(reader):
+    """Read a request's head and body, and return them as bytes.
+
+    Return None if the client closed the connection between requests.
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    except asyncio.LimitOverrunError:
+        raise RequestError(b'HTTP/1.1 431 Request Header Fields Too Large\r\n'
+                           b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'transfer-encoding':
+            raise RequestError(b'HTTP/1.1 411 Length Required\r\n'
+                               b'Content-Length: 0\r\n'
+                               b'Connection: close\r\n\r\n')
+        if name == b'content-length':
+            value = value.strip()
+            if not value.isdigit():
+                raise RequestError(b'HTTP/1.1 400 Bad Request\r\n'
+                                   b'Content-Length: 0\r\n'
+                                   b'Connection: close\r\n\r\n')
+            length = int(value)
+    if length > MAX_BODY_SIZE:
+        raise RequestError(b'HTTP/1.1 413 Payload Too Large\r\n'
+                           b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+    body = await reader.readexactly(length)
+    return head + body
+
+
+class AsyncWebServer:
+    """Serve WebServerHandler routes from an asyncio event loop.
+
+    Parameters
+    ----------
+    threads : int
+        Maximum number of requests handled (and thus of database
+        sessions in use) at the same time.
+    timeout : float
+        Seconds before closing idle keep-alive connections.
+    """
+
+    def __init__(self, threads=8, timeout=WebServerHandler.timeout):
+        self.executor = ThreadPoolExecutor(threads)
+        self.timeout = timeout
+        self.connections = set()
+        # Connections waiting for their next request.
+        self.idle = set()
+        self.stopping = False
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        client_address = writer.get_extra_info('peername')
+        self.connections.add(task)
+        try:
+            while not self.stopping:
+                self.idle.add(task)
+                try:
+                    data = await asyncio.wait_for(read_request(reader),
+                                                  self.timeout)
+                finally:
+                    self.idle.discard(task)
+                if data is None:
+                    break
+                response, keep_alive = await loop.run_in_executor(
+                    self.executor, run_handler, data, client_address)
+                writer.write(response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except RequestError as e:
+            writer.write(e.args[0])
+        except (asyncio.CancelledError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def serve(self, host='', port=8080):
+        """Serve until SIGINT or SIGTERM, then drain in-flight requests."""
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(
+                signum, lambda: stop.done() or stop.set_result(None))
+
+        server = await asyncio.start_server(self.handle_connection,
+                                            host or None, port,
+                                            limit=MAX_HEADER_SIZE)
+        async with server:
+            await stop
+
+        self.stopping = True
+        for task in self.idle:
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Size of the request thread pool (default: 8).')
+    parser.add_argument('--timeout', type=float,
+                        default=WebServerHandler.timeout,
+                        help='Seconds before closing idle connections '
+                             f'(default: {WebServerHandler.timeout}).')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Serve request metrics on /metrics.')
+    args = parser.parse_args()
+    if args.metrics:
+        enable_metrics()
+    print(f'Server running on port {args.port} (asyncio, '
+          f'{args.threads} thread(s)).')
+    server = AsyncWebServer(args.threads, args.timeout)
+    asyncio.run(server.serve(port=args.port))
+    print('Server stopped.')
+
+
+if __name__ == '__main__':
+    main()
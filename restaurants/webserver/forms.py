@@ -0,0 +1,256 @@
+"""Streaming parser for POSTed forms.
+
+Supports application/x-www-form-urlencoded and multipart/form-data
+bodies. The body is read from the request's stream in chunks and parsed
+incrementally, so that memory use is bounded by the size of the fields
+rather than by the size of the body. Uploaded files are spooled to disk.
+"""
+
+from email.message import Message
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qsl
+
+
+MAX_BODY_SIZE = 10 * 1024 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+MAX_PART_HEADERS_SIZE = 8 * 1024
+CHUNK_SIZE = 64 * 1024
+# Uploaded files bigger than this are written to disk.
+SPOOL_SIZE = 1024 * 1024
+
+
+class FormError(Exception):
+    """The form cannot be parsed.
+
+    Attributes
+    ----------
+    status : int
+        HTTP status code to respond with.
+    message : str
+    """
+
+    def __init__(self, status, message):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+class UploadedFile:
+    """A file field of a multipart form.
+
+    Attributes
+    ----------
+    filename : str
+    content_type : str
+    file : file object, positioned at its start once parsed
+    """
+
+    def __init__(self, filename, content_type):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+
+def parse_header(value):
+    """Return the value and the parameters of a header like Content-Type."""
+    message = Message()
+    message['content-type'] = value or ''
+    params = dict(message.get_params()[1:])
+    return message.get_content_type(), params
+
+
+def iter_chunks(rfile, length, chunk_size=CHUNK_SIZE):
+    """Yield the `length` next bytes of a stream, chunk by chunk."""
+    while length > 0:
+        chunk = rfile.read(min(chunk_size, length))
+        if not chunk:
+            raise FormError(400, 'Incomplete request body')
+        length -= len(chunk)
+        yield chunk
+
+
+def add_field(fields, name, value):
+    fields.setdefault(name, []).append(value)
+
+
+def parse_urlencoded(chunks, max_field_size=MAX_FIELD_SIZE):
+    """Return the {name: [values]} of an urlencoded form."""
+    fields = {}
+    pending = b''
+
+    def add_pairs(data):
+        pairs = parse_qsl(data.decode('latin-1'), keep_blank_values=True,
+                          encoding='utf-8', errors='replace')
+        for name, value in pairs:
+            add_field(fields, name, value)
+
+    for chunk in chunks:
+        *complete, pending = (pending + chunk).split(b'&')
+        for pair in complete:
+            add_pairs(pair)
+        if len(pending) > max_field_size:
+            raise FormError(413, 'Form field too large')
+    add_pairs(pending)
+    return fields
+
+
+class MultipartParser:
+    """Incremental multipart/form-data parser.
+
+    Feed it the body chunk by chunk, then call close() to get the
+    {name: [values]} of the form. Values are strings, or UploadedFile
+    objects for file fields.
+    """
+
+    def __init__(self, boundary, max_field_size=MAX_FIELD_SIZE):
+        self.delimiter = b'\r\n--' + boundary
+        self.max_field_size = max_field_size
+        self.fields = {}
+        # The first delimiter is not preceded by a line break.
+        self.buffer = b'\r\n'
+        self.state = 'preamble'
+        self.part = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        while getattr(self, '_parse_' + self.state)():
+            pass
+
+    def close(self):
+        if self.state != 'epilogue':
+            raise FormError(400, 'Incomplete multipart body')
+        return self.fields
+
+    # Each state's method consumes what it can from the buffer, and
+    # returns whether parsing can go on with the next state.
+
+    def _parse_preamble(self):
+        return self._parse_body()
+
+    def _parse_body(self):
+        index = self.buffer.find(self.delimiter)
+        if index < 0:
+            # Keep what could be the start of a delimiter.
+            keep = len(self.delimiter) - 1
+            if len(self.buffer) > keep:
+                self._write(self.buffer[:-keep])
+                self.buffer = self.buffer[-keep:]
+            return False
+        self._write(self.buffer[:index])
+        self._end_part()
+        self.buffer = self.buffer[index + len(self.delimiter):]
+        self.state = 'delimiter'
+        return True
+
+    def _parse_delimiter(self):
+        if self.buffer.startswith(b'--'):
+            self.state = 'epilogue'
+            return self._parse_epilogue()
+        index = self.buffer.find(b'\r\n')
+        if index < 0:
+            if len(self.buffer) > MAX_PART_HEADERS_SIZE:
+                raise FormError(400, 'Malformed multipart body')
+            return False
+        # Skip transport padding, keep the line break for headers.
+        self.buffer = self.buffer[index:]
+        self.state = 'headers'
+        return True
+
+    def _parse_headers(self):
+        index = self.buffer.find(b'\r\n\r\n')
+        if index < 0:
+            if len(self.buffer) > MAX_PART_HEADERS_SIZE:
+                raise FormError(400, 'Multipart headers too large')
+            return False
+        headers = {}
+        for line in self.buffer[2:index].split(b'\r\n'):
+            name, _, value = line.decode('utf-8', 'replace').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        self.buffer = self.buffer[index + 4:]
+        self._start_part(headers)
+        self.state = 'body'
+        return True
+
+    def _parse_epilogue(self):
+        self.buffer = b''
+        return False
+
+    def _start_part(self, headers):
+        _, params = parse_header('x/x; ' + headers.get(
+            'content-disposition', '').partition(';')[2])
+        name = params.get('name')
+        if name is None:
+            raise FormError(400, 'Multipart part without a name')
+        filename = params.get('filename')
+        if filename is not None:
+            content_type = headers.get('content-type',
+                                       'application/octet-stream')
+            value = UploadedFile(filename, content_type)
+        else:
+            value = bytearray()
+        self.part = (name, value)
+
+    def _write(self, data):
+        if self.part is None or not data:
+            return
+        name, value = self.part
+        if isinstance(value, UploadedFile):
+            value.file.write(data)
+            return
+        if len(value) + len(data) > self.max_field_size:
+            raise FormError(413, 'Form field too large')
+        value.extend(data)
+
+    def _end_part(self):
+        if self.part is None:
+            return
+        name, value = self.part
+        if isinstance(value, UploadedFile):
+            value.file.seek(0)
+        else:
+            value = value.decode('utf-8', 'replace')
+        add_field(self.fields, name, value)
+        self.part = None
+
+
+def parse_form(rfile, headers, max_body_size=MAX_BODY_SIZE,
+               max_field_size=MAX_FIELD_SIZE):
+    """Read and parse a POSTed form, return its {name: [values]}.
+
+    Bodies of other content types are read and discarded, and give
+    an empty form. Raise FormError if the form cannot be parsed.
+
+    Parameters
+    ----------
+    rfile : file object
+        Stream positioned at the start of the request body.
+    headers : Message
+        The request headers.
+    max_body_size : int
+    max_field_size : int
+        Maximum size in bytes of a non-file field.
+    """
+    if 'Transfer-Encoding' in headers:
+        raise FormError(411, 'Length required')
+    try:
+        length = int(headers.get('Content-Length') or 0)
+    except ValueError:
+        raise FormError(400, 'Invalid Content-Length')
+    if length > max_body_size:
+        raise FormError(413, 'Request body too large')
+    chunks = iter_chunks(rfile, length)
+
+    content_type, params = parse_header(headers.get('Content-Type'))
+    if content_type == 'application/x-www-form-urlencoded':
+        return parse_urlencoded(chunks, max_field_size)
+    if content_type == 'multipart/form-data':
+        boundary = params.get('boundary')
+        if not boundary:
+            raise FormError(400, 'Missing multipart boundary')
+        parser = MultipartParser(boundary.encode('latin-1'), max_field_size)
+        for chunk in chunks:
+            parser.feed(chunk)
+        return parser.close()
+    for chunk in chunks:
+        pass
+    return {}
@@ -0,0 +1,8 @@
+"""Request metrics of the webserver, see request_metrics.py."""
+
+import os
+import sys
+
+# request_metrics.py is shared with the Flask app, one directory up.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from request_metrics import CONTENT_TYPE, Metrics  # noqa: E402,F401
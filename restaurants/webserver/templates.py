@@ -0,0 +1,42 @@
+"""Minimal HTML templates, compiled once into pre-encoded chunks."""
+
+import gzip
+from html import escape
+from string import Formatter
+
+
+class Template:
+    """HTML template with {name} slots.
+
+    The source is parsed once into a list of UTF-8 encoded chunks and
+    slot names, so that rendering only encodes the (HTML-escaped) slot
+    values. Templates without slots are fully pre-encoded, including
+    their gzip-compressed version.
+
+    Use {{ and }} for literal braces.
+    """
+
+    def __init__(self, source):
+        self.parts = []
+        for literal, slot, _, _ in Formatter().parse(source):
+            if literal:
+                literal = literal.encode('utf-8')
+                if self.parts and isinstance(self.parts[-1], bytes):
+                    # Escaped braces split literals in several pieces.
+                    self.parts[-1] += literal
+                else:
+                    self.parts.append(literal)
+            if slot is not None:
+                self.parts.append(slot)
+        self.static = all(isinstance(part, bytes) for part in self.parts)
+        self.gzipped = None
+        if self.static:
+            self.gzipped = gzip.compress(b''.join(self.parts))
+
+    def render(self, **values):
+        """Return the list of encoded chunks of the filled template."""
+        if self.static:
+            return self.parts
+        return [part if isinstance(part, bytes)
+                else escape(str(values[part])).encode('utf-8')
+                for part in self.parts]
@@ -1,30 +1,134 @@
 """Simple webserver allowing to interact with the database."""
 
-import re
-from io import StringIO
-from contextlib import contextmanager
+import os
+import gzip
+import signal
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
-import cgi
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
 from database_setup import Base, Restaurant
+from forms import FormError, parse_form
+from metrics import CONTENT_TYPE, Metrics
+from templates import Template
+
+
+# Run on every new connection. In WAL mode, readers do not block
+# writers and vice versa.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # milliseconds
+    'cache_size': -64000,  # kibibytes, i.e. 64MB
+    'mmap_size': 268435456,  # bytes, i.e. 256MB
+}
 
 
 def create_db():
-    """Create a database session and return it."""
+    """Create a thread-local database session registry and return it."""
     engine = create_engine('sqlite:///restaurantmenu.db')
     Base.metadata.bind = engine
 
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
     DBSession = sessionmaker(bind=engine)
-    return DBSession()
+    return scoped_session(DBSession)
 
 
 db = create_db()
 
 
+class Router:
+    """Map request paths to handler method names.
+
+    Routes are stored in a trie of path segments, so that matching
+    a path costs the same however many routes there are.
+    Segments written as <int:name> match digits, which are passed
+    to the handler as the `name` keyword argument.
+    """
+
+    class Node:
+        def __init__(self):
+            self.children = {}
+            self.param = None  # (name, child node)
+            self.handlers = {}
+
+    def __init__(self):
+        self.root = self.Node()
+
+    @staticmethod
+    def split(path):
+        return [segment for segment in path.split('/') if segment]
+
+    def add(self, pattern, method, handler):
+        """Route requests with the given method and path to handler."""
+        node = self.root
+        for segment in self.split(pattern):
+            if segment.startswith('<int:') and segment.endswith('>'):
+                name = segment[len('<int:'):-1]
+                if node.param is None:
+                    node.param = (name, self.Node())
+                node = node.param[1]
+            else:
+                node = node.children.setdefault(segment, self.Node())
+        node.handlers[method] = handler
+
+    def match(self, path):
+        """Return the {method: handler} routes of a path and its params.
+
+        Return (None, {}) if no route matches the path.
+        """
+        node = self.root
+        params = {}
+        for segment in self.split(path):
+            child = node.children.get(segment)
+            if child is None and node.param is not None \
+                    and segment.isdigit():
+                name, child = node.param
+                params[name] = int(segment)
+            if child is None:
+                return None, {}
+            node = child
+        if not node.handlers:
+            return None, {}
+        return node.handlers, params
+
+
+router = Router()
+router.add('/restaurants', 'GET', 'list_restaurants')
+router.add('/restaurants/new', 'GET', 'add_restaurant_form')
+router.add('/restaurants/new', 'POST', 'add_restaurant')
+router.add('/restaurants/<int:id>/edit', 'GET', 'edit_restaurant_form')
+router.add('/restaurants/<int:id>/edit', 'POST', 'edit_restaurant')
+router.add('/restaurants/<int:id>/delete', 'GET', 'delete_restaurant_form')
+router.add('/restaurants/<int:id>/delete', 'POST', 'delete_restaurant')
+router.add('/hello', 'GET', 'hello_form')
+router.add('/hello', 'POST', 'hello')
+
+
 class WebServerHandler(BaseHTTPRequestHandler):
     """Simple webserver handler."""
 
+    # Keep connections open between requests...
+    protocol_version = 'HTTP/1.1'
+    # ...but close them after this many idle seconds.
+    timeout = 15
+    # Headers and body are sent separately: without TCP_NODELAY, the
+    # body would wait for the client to acknowledge the headers, which
+    # it delays by up to 40ms on a persistent connection.
+    disable_nagle_algorithm = True
+    # Smaller responses are not worth compressing.
+    gzip_min_size = 512
+    # Set by enable_metrics().
+    metrics = None
+
     forms = {
         'hello': (
             "<form method='POST' enctype='multipart/form-data' "
@@ -35,7 +139,7 @@ class WebServerHandler(BaseHTTPRequestHandler):
             "</form>"
         ),
         'restaurant-add': (
-            "<form method='POST' enctype='multipart/form-data'"
+            "<form method='POST' enctype='multipart/form-data' "
             "action='/restaurants/new'>"
             "<h1>Create a restaurant</h1>"
             "<input name='name' type='text'>"
@@ -43,7 +147,7 @@ class WebServerHandler(BaseHTTPRequestHandler):
             "</form>"
         ),
         'restaurant-edit': (
-            "<form method='POST' enctype='multipart/form-data'"
+            "<form method='POST' enctype='multipart/form-data' "
             "action='/restaurants/{id}/edit'>"
             "<h1>Edit a restaurant</h1>"
             "<h2>Enter a new name for {name}</h2>"
@@ -60,184 +164,358 @@ class WebServerHandler(BaseHTTPRequestHandler):
             "<a href='/restaurants'>Back</a>"
         ),
     }
-    regex = {
-        'restaurant-edit': r'/restaurants/(?P<id>\d+)/edit$',
-        'restaurant-delete': r'/restaurants/(?P<id>\d+)/delete$',
+    # Compiled once, when the module is loaded.
+    templates = {
+        'page-start': Template("<html><body>"),
+        'restaurant-list-item': Template(
+            "<p>{name}"
+            "<br/><a href='/restaurants/{id}/edit'>Edit</a>"
+            "<br/><a href='/restaurants/{id}/delete'>Delete</a>"
+            "</p>"
+        ),
+        'restaurant-list-end': Template(
+            "<a href='/restaurants/new'>Add restaurant</a></body></html>"
+        ),
+        'restaurant-add': Template(
+            "<html><body>" + forms['restaurant-add'] + "</body></html>"
+        ),
+        'restaurant-edit': Template(
+            "<html><body>" + forms['restaurant-edit'] + "</body></html>"
+        ),
+        'restaurant-delete': Template(
+            "<html><body>" + forms['restaurant-delete'] + "</body></html>"
+        ),
+        'hello': Template(
+            "<html><body>Hello!" + forms['hello'] + "</body></html>"
+        ),
+        'hello-answer': Template(
+            "<html><body>"
+            "<h2>Okay, how about this?</h2>"
+            "<h1>{message}</h1>"
+            + forms['hello'] +
+            "</body></html>"
+        ),
     }
 
-    @contextmanager
-    def page(self):
-        """Context manager.
-
-        Ensures the page starts and ends with HTML and body tags.
-        Return a string stream.
-        """
-        page = StringIO()
-        page.write("<html><body>")
-        yield page
-        page.write("</body></html>")
-        output = page.getvalue()
-        self.writebytes(output)
+    def handle_one_request(self):
+        self.endpoint = None
+        self.status_code = None
+        self.response_size = 0
+        try:
+            super().handle_one_request()
+        finally:
+            # Release this thread's session, rolling back anything left.
+            db.remove()
+            if self.metrics is not None and self.status_code is not None:
+                self.metrics.finish(self.endpoint, self.command,
+                                    self.status_code, self.response_size)
+
+    def parse_request(self):
+        # Called once the request line is read, so that the time spent
+        # waiting for a request on a kept-alive connection is not counted.
+        if self.metrics is not None:
+            self.metrics.start()
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
 
     # helper methods
 
-    def default_header(self, status_code, redirect=None):
+    def accepts_gzip(self):
+        """Return whether the client accepts gzip-encoded responses."""
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, *params = coding.split(';')
+            if name.strip().lower() not in ('gzip', '*'):
+                continue
+            for param in params:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
+    def respond(self, status_code, chunks=(), redirect=None, gzipped=None,
+                content_type='text/html; charset=utf-8'):
+        """Send a complete response, compressing the body if possible.
+
+        Parameters
+        ----------
+        status_code : int
+        chunks : list of bytes
+            The body of the response.
+        redirect : str, optional
+            URL of the Location header.
+        gzipped : bytes, optional
+            The body, already compressed.
+        content_type : str
+        """
         self.send_response(status_code)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-type', content_type)
         if redirect:
             self.send_header('Location', redirect)
+        length = sum(map(len, chunks))
+        if length >= self.gzip_min_size:
+            self.send_header('Vary', 'Accept-Encoding')
+            if self.accepts_gzip():
+                if gzipped is None:
+                    gzipped = gzip.compress(b''.join(chunks), compresslevel=6)
+                chunks, length = [gzipped], len(gzipped)
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(length))
+        if self.metrics is not None:
+            self.send_header('Server-Timing', self.metrics.server_timing())
         self.end_headers()
-
-    def writebytes(self, s):
-        self.wfile.write(bytes(s, 'utf-8'))
+        # wfile is unbuffered: write the body at once, not chunk by chunk.
+        self.wfile.write(b''.join(chunks))
+        self.response_size = length
+
+    def render_template(self, template, **values):
+        """Return the encoded chunks of one of the templates, filled."""
+        if self.metrics is None:
+            return self.templates[template].render(**values)
+        with self.metrics.rendering():
+            return self.templates[template].render(**values)
+
+    def render(self, template, status_code=200, **values):
+        """Send a page rendered from one of the templates."""
+        self.respond(status_code, self.render_template(template, **values),
+                     gzipped=self.templates[template].gzipped)
+
+    def form_field(self, name, default=None):
+        """Return the value of a field of the POSTed form, or default."""
+        return self.form.get(name, [default])[0]
+
+    def get_restaurant(self, id):
+        """Return a restaurant, or send a 404 error and return None."""
+        restaurant = db.query(Restaurant).get(id)
+        if restaurant is None:
+            self.send_error(404, f'File not found: {self.path}')
+        return restaurant
 
     # request handlers
 
     def do_GET(self):
-        try:
-            # list restaurant page
-            if self.path.endswith('/restaurants'):
-                self.default_header(200)
-                restaurants = db.query(Restaurant).all()
-                with self.page() as page:
-                    for restaurant in restaurants:
-                        page.write('<p>')
-                        page.write(restaurant.name)
-                        edit_url = f'/restaurants/{restaurant.id}/edit'
-                        page.write(f"<br/><a href='{edit_url}'>Edit</a>")
-                        delete_url = f'/restaurants/{restaurant.id}/delete'
-                        page.write(f"<br/><a href='{delete_url}'>Delete</a>")
-                        page.write('</p>')
-                    page.write('<a href="/restaurants/new">Add restaurant</a>')
-
-            # add restaurant page
-            if self.path.endswith('/restaurants/new'):
-                self.default_header(200)
-                with self.page() as page:
-                    page.write(self.forms['restaurant-add'])
-
-            # edit restaurant page
-            regex = self.regex['restaurant-edit']
-            m = re.search(regex, self.path)
-            if m:
-                self.default_header(200)
-                id_ = m.group('id')
-                restaurant = db.query(Restaurant).get(id_)
-                if restaurant is None:
-                    raise IOError
-                with self.page() as page:
-                    page.write(self.forms['restaurant-edit'].format(
-                        id=id_,
-                        name=restaurant.name))
-
-            # delete restaurant page
-            regex = self.regex['restaurant-delete']
-            m = re.search(regex, self.path)
-            if m:
-                self.default_header(200)
-                id_ = m.group('id')
-                restaurant = db.query(Restaurant).get(id_)
-                if restaurant is None:
-                    raise IOError
-                with self.page() as page:
-                    page.write(self.forms['restaurant-delete'].format(
-                        id=id_,
-                        name=restaurant.name))
-
-            if self.path.endswith('/hello'):
-                self.default_header(200)
-                with self.page() as page:
-                    page.write('Hello!')
-                    page.write(self.forms['hello'])
-
-        except IOError as e:
-            self.send_error(404, f'File not found: {self.path}')
+        self.dispatch('GET')
 
     def do_POST(self):
         try:
-            # add restaurant
-            if self.path.endswith('/restaurants/new'):
-                ctype, pdict = cgi.parse_header(self.headers['content-type'])
-                pdict['boundary'] = pdict['boundary'].encode()
-                if ctype == 'multipart/form-data':
-                    fields = cgi.parse_multipart(self.rfile, pdict)
-                    name_content = fields.get('name')
-                name = name_content[0].decode()
-
-                restaurant = Restaurant(name=name)
-                db.add(restaurant)
-                db.commit()
-
-                self.default_header(301, redirect='/restaurants')
-
-            # edit restaurant
-            regex = self.regex['restaurant-edit']
-            m = re.search(regex, self.path)
-            if m:
-                id_ = m.group('id')
-                ctype, pdict = cgi.parse_header(self.headers['content-type'])
-                pdict['boundary'] = pdict['boundary'].encode()
-                if ctype == 'multipart/form-data':
-                    fields = cgi.parse_multipart(self.rfile, pdict)
-                    name_content = fields.get('name')
-                name = name_content[0].decode()
-
-                restaurant = db.query(Restaurant).get(id_)
-                if restaurant is None:
-                    raise IOError
-
-                restaurant.name = name
-                db.add(restaurant)
-                db.commit()
-
-                self.default_header(301, redirect='/restaurants')
-
-            # delete restaurant
-            regex = self.regex['restaurant-delete']
-            m = re.search(regex, self.path)
-            if m:
-                id_ = m.group('id')
-
-                restaurant = db.query(Restaurant).get(id_)
-                if restaurant is None:
-                    raise IOError
-
-                db.delete(restaurant)
-                db.commit()
-
-                self.default_header(301, redirect='/restaurants')
-
-            elif self.path.endswith('/hello'):
-                self.default_header(301)
-
-                ctype, pdict = cgi.parse_header(self.headers['content-type'])
-                pdict['boundary'] = pdict['boundary'].encode()
-                if ctype == 'multipart/form-data':
-                    fields = cgi.parse_multipart(self.rfile, pdict)
-                    messagecontent = fields.get('message')
-                message = messagecontent[0].decode()
-
-                with self.page() as page:
-                    page.write(
-                        "<h2>Okay, how about this?</h2>"
-                        f"<h1>{message}</h1>"
-                    )
-                    page.write(self.forms['hello'])
-
-        except Exception as e:
-            raise
+            self.form = parse_form(self.rfile, self.headers)
+        except FormError as e:
+            # Also closes the connection, as the body may be partly unread.
+            self.send_error(e.status, e.message)
+            return
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        """Call the handler method routed for the request's path."""
+        path = self.path.partition('?')[0]
+        handlers, params = router.match(path)
+        if handlers is None:
+            self.send_error(404, f'File not found: {self.path}')
+        elif method not in handlers:
+            self.send_response(405)
+            self.send_header('Allow', ', '.join(sorted(handlers)))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.endpoint = handlers[method]
+            getattr(self, handlers[method])(**params)
+
+    # list restaurants
+
+    def list_restaurants(self):
+        restaurants = db.query(Restaurant.id, Restaurant.name).all()
+        chunks = self.render_template('page-start')[:]
+        for restaurant in restaurants:
+            chunks.extend(self.render_template(
+                'restaurant-list-item', id=restaurant.id,
+                name=restaurant.name))
+        chunks.extend(self.render_template('restaurant-list-end'))
+        self.respond(200, chunks)
+
+    # add restaurant
+
+    def add_restaurant_form(self):
+        self.render('restaurant-add')
+
+    def add_restaurant(self):
+        name = self.form_field('name')
+        if not name:
+            self.send_error(400, 'Missing name')
+            return
+        restaurant = Restaurant(name=name)
+        db.add(restaurant)
+        db.commit()
+        self.respond(301, redirect='/restaurants')
+
+    # edit restaurant
+
+    def edit_restaurant_form(self, id):
+        restaurant = self.get_restaurant(id)
+        if restaurant is None:
+            return
+        self.render('restaurant-edit', id=id, name=restaurant.name)
+
+    def edit_restaurant(self, id):
+        name = self.form_field('name')
+        if not name:
+            self.send_error(400, 'Missing name')
+            return
+        restaurant = self.get_restaurant(id)
+        if restaurant is None:
+            return
+        restaurant.name = name
+        db.add(restaurant)
+        db.commit()
+        self.respond(301, redirect='/restaurants')
+
+    # delete restaurant
+
+    def delete_restaurant_form(self, id):
+        restaurant = self.get_restaurant(id)
+        if restaurant is None:
+            return
+        self.render('restaurant-delete', id=id, name=restaurant.name)
+
+    def delete_restaurant(self, id):
+        restaurant = self.get_restaurant(id)
+        if restaurant is None:
+            return
+        db.delete(restaurant)
+        db.commit()
+        self.respond(301, redirect='/restaurants')
+
+    # hello
+
+    def hello_form(self):
+        self.render('hello')
+
+    def hello(self):
+        message = self.form_field('message', '')
+        self.render('hello-answer', message=message)
+
+    # metrics
+
+    def show_metrics(self):
+        self.respond(200, [self.metrics.render().encode('utf-8')],
+                     content_type=CONTENT_TYPE)
+
+
+def enable_metrics():
+    """Record the metrics of requests, and serve them on /metrics.
+
+    Responses also get a Server-Timing header.
+    """
+    WebServerHandler.metrics = Metrics()
+    WebServerHandler.metrics.instrument_engine(db.get_bind())
+    router.add('/metrics', 'GET', 'show_metrics')
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTP server handling requests in a bounded pool of threads."""
+
+    def __init__(self, server_address, RequestHandlerClass, threads):
+        super().__init__(server_address, RequestHandlerClass)
+        self.executor = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread,
+                             request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        # Wait for in-flight requests to finish.
+        self.executor.shutdown(wait=True)
+
+
+def serve(server):
+    """Serve until SIGINT or SIGTERM, then drain in-flight requests."""
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it must
+        # not be called from the thread running it.
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+    server.server_close()
+
+
+def prefork(server, workers):
+    """Serve from `workers` child processes sharing the listening socket."""
+    # Idle workers all wake up on a new connection; only one of them
+    # gets it, the others must not block in accept().
+    server.socket.setblocking(False)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # Do not share the parent's database connections.
+            db.get_bind().dispose()
+            serve(server)
+            os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+    server.server_close()
 
 
 def main():
     """Main webserver loop."""
-    try:
-        port = 8080
-        server = HTTPServer(('', port), WebServerHandler)
-        print(f'Server running on port {port}.')
-        server.serve_forever()
-    except KeyboardInterrupt:
-        print('Stopping the server...')
-        server.socket.close()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes (default: 1).')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of threads per process (default: 1).')
+    parser.add_argument('--timeout', type=float,
+                        default=WebServerHandler.timeout,
+                        help='Seconds before closing idle connections '
+                             f'(default: {WebServerHandler.timeout}).')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Serve request metrics on /metrics '
+                             '(per worker process).')
+    args = parser.parse_args()
+
+    WebServerHandler.timeout = args.timeout
+    if args.metrics:
+        enable_metrics()
+    if args.threads == 1:
+        # An idle keep-alive connection would hold the only thread.
+        WebServerHandler.protocol_version = 'HTTP/1.0'
+
+    if args.threads > 1:
+        server = ThreadPoolHTTPServer(('', args.port), WebServerHandler,
+                                      args.threads)
+    else:
+        server = HTTPServer(('', args.port), WebServerHandler)
+    print(f'Server running on port {args.port} '
+          f'({args.workers} worker(s), {args.threads} thread(s) each).')
+    if args.workers > 1:
+        prefork(server, args.workers)
+    else:
+        serve(server)
+    print('Server stopped.')
 
 
 if __name__ == '__main__':